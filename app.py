@@ -1,10 +1,33 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 from dotenv import load_dotenv
 import os
 import json
 import datetime
 import re
-from sentence_transformers import SentenceTransformer
+import sys
+import csv
+import random
+import sqlite3
+import math
+import hashlib
+import threading
+import time
+import atexit
+import queue
+import secrets
+import bisect
+import itertools
+import contextlib
+import contextvars
+import shutil
+import tempfile
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:  # Windows: one process per spool directory
+    fcntl = None
 import numpy as np
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
@@ -14,409 +37,1822 @@ load_dotenv()
 
 app = Flask(__name__)
 
-# Initialize knowledge base
+def normalize(vectors):
+    # L2-normalise along the last axis so dot products are cosine similarities
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(vectors / norms)
+
+def normalize_question(text):
+    # Case, punctuation and spacing differences shouldn't defeat the caches
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+# Thread-safe LRU cache with an optional time-to-live (ttl <= 0 never expires)
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, count_miss=True):
+        # count_miss=False for a probe whose miss will be looked up again
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (self.ttl <= 0 or entry[1] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._data[key]
+            self.misses += count_miss
+            return None
+    
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+# Latency histograms per (stage, state) and event counters, rendered in the
+# Prometheus text format by /metrics. Under Gunicorn any worker may answer a
+# scrape, so with a directory set each process also writes a snapshot of its
+# own to metrics-<pid>.json every flush_interval seconds (and at exit), and
+# render() adds up every process's. Snapshots of exited workers are folded
+# into metrics-retired.json so their counts aren't lost; gauges only come
+# from live processes
+class Metrics:
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, prefix="agentops", directory=None, flush_interval=5.0):
+        self.prefix = prefix
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.histograms = {}  # (stage, state) -> [bucket counts..., +Inf count, sum]
+        self.counters = {}  # (name, labels) -> count
+        self.collectors = []  # callables returning (name, labels, value) for gauges read at scrape time
+        self._lock = threading.Lock()
+        self._pid = None
+        self._parent = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            os.register_at_fork(after_in_child=self._start_in_child)
+            atexit.register(self.flush)
+    
+    def _ensure_flusher(self):
+        # Started on first use in each process; threads don't survive a fork
+        if self.directory and self._pid != os.getpid():
+            with self._lock:
+                if self._pid == os.getpid():
+                    return
+                self._pid = os.getpid()
+            def run():
+                while True:
+                    time.sleep(self.flush_interval)
+                    self.flush()
+            threading.Thread(target=run, name="metrics-flusher", daemon=True).start()
+    
+    def _start_in_child(self):
+        # A forked worker starts from zero: what it inherited is the parent's
+        # to report. The parent serves nothing, so its gauges are skipped
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self._parent = os.getppid()
+    
+    def observe(self, stage, seconds, state=""):
+        self._ensure_flusher()
+        with self._lock:
+            histogram = self.histograms.get((stage, state))
+            if histogram is None:
+                histogram = self.histograms[(stage, state)] = [0] * (len(self.BUCKETS) + 2)
+            histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+    
+    def since(self, stage, start, state=""):
+        # Observe the time since a time.perf_counter() reading; returns now
+        now = time.perf_counter()
+        self.observe(stage, now - start, state)
+        return now
+    
+    def inc(self, name, amount=1, **labels):
+        self._ensure_flusher()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def snapshot(self):
+        # This process's histograms, counters and current gauge values
+        with self._lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            counters = dict(self.counters)
+        gauges = {}
+        for collect in self.collectors:
+            for gauge, pairs, value in collect():
+                key = (gauge, tuple(pairs))
+                gauges[key] = gauges.get(key, 0) + value
+        return histograms, counters, gauges
+    
+    def flush(self):
+        if not self.directory or self._pid != os.getpid():
+            return
+        histograms, counters, gauges = self.snapshot()
+        try:
+            self._write(os.path.join(self.directory, f"metrics-{os.getpid()}.json"), histograms, counters, gauges)
+        except OSError as e:
+            print(f"Error writing metrics snapshot: {e}")
+    
+    def _write(self, path, histograms, counters, gauges):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "histograms": [[stage, state, histogram] for (stage, state), histogram in histograms.items()],
+                "counters": [[name, pairs, value] for (name, pairs), value in counters.items()],
+                "gauges": [[name, pairs, value] for (name, pairs), value in gauges.items()]
+            }, f)
+        os.replace(tmp, path)
+    
+    def _read(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        histograms = {(stage, state): histogram for stage, state, histogram in data["histograms"]}
+        counters = {(name, tuple(map(tuple, pairs))): value for name, pairs, value in data["counters"]}
+        gauges = {(name, tuple(map(tuple, pairs))): value for name, pairs, value in data["gauges"]}
+        return histograms, counters, gauges
+    
+    @staticmethod
+    def _add(totals, histograms, counters, gauges=None):
+        for key, histogram in histograms.items():
+            total = totals[0].setdefault(key, [0] * len(histogram))
+            for i, value in enumerate(histogram):
+                total[i] += value
+        for key, value in counters.items():
+            totals[1][key] = totals[1].get(key, 0) + value
+        for key, value in (gauges or {}).items():
+            totals[2][key] = totals[2].get(key, 0) + value
+    
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    def _pids(self):
+        # Pids with a snapshot in the directory, other than ours
+        pids = []
+        for name in os.listdir(self.directory):
+            match = re.fullmatch(r"metrics-(\d+)\.json", name)
+            if match is not None and int(match.group(1)) != os.getpid():
+                pids.append(int(match.group(1)))
+        return pids
+    
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        # Held shared while reading snapshots and exclusively while folding
+        # exited processes' into the retired one, so no scrape counts a
+        # process twice or not at all
+        with open(os.path.join(self.directory, "metrics.lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+    
+    def _snapshots(self):
+        # The retired snapshot and every other process's, as (pid, data) with
+        # pid None for the retired one
+        if any(not self._alive(pid) for pid in self._pids()):
+            self._retire()
+        snapshots = []
+        with self._locked(shared=True):
+            for pid in [None] + self._pids():
+                try:
+                    snapshots.append((pid, self._read(os.path.join(self.directory, f"metrics-{pid or 'retired'}.json"))))
+                except FileNotFoundError:
+                    continue
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Error reading metrics snapshot of {pid or 'retired workers'}: {e}")
+        return snapshots
+    
+    def _retire(self):
+        with self._locked():
+            retired = os.path.join(self.directory, "metrics-retired.json")
+            totals = ({}, {}, {})
+            try:
+                self._add(totals, *self._read(retired)[:2])
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error reading metrics snapshot of retired workers: {e}")
+                return
+            paths = []
+            for pid in self._pids():
+                if self._alive(pid):
+                    continue
+                path = os.path.join(self.directory, f"metrics-{pid}.json")
+                try:
+                    self._add(totals, *self._read(path)[:2])
+                except (OSError, ValueError, KeyError):
+                    continue
+                paths.append(path)
+            if paths:
+                self._write(retired, totals[0], totals[1], {})
+                for path in paths:
+                    os.remove(path)
+    
+    def render(self):
+        def labels(pairs):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+        
+        totals = ({}, {}, {})
+        self._add(totals, *self.snapshot())
+        if self.directory:
+            for pid, (histograms, counters, gauges) in self._snapshots():
+                live = pid is not None and pid != self._parent and self._alive(pid)
+                self._add(totals, histograms, counters, gauges if live else None)
+        histograms, counters, gauges = totals
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# TYPE {name} histogram"]
+        for (stage, state), histogram in sorted(histograms.items()):
+            base = [("stage", stage), ("state", state)]
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{labels(base + [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{labels(base)} {histogram[-1]}")
+            lines.append(f"{name}_count{labels(base)} {cumulative}")
+        typed = set()
+        for (counter, pairs), value in sorted(counters.items()):
+            if counter not in typed:
+                lines.append(f"# TYPE {self.prefix}_{counter}_total counter")
+                typed.add(counter)
+            lines.append(f"{self.prefix}_{counter}_total{labels(pairs)} {value}")
+        for (gauge, pairs), value in sorted(gauges.items()):
+            if gauge not in typed:
+                lines.append(f"# TYPE {self.prefix}_{gauge} gauge")
+                typed.add(gauge)
+            lines.append(f"{self.prefix}_{gauge}{labels(pairs)} {value}")
+        return "\n".join(lines) + "\n"
+
+# METRICS_DIR is where processes share their snapshots. gunicorn.conf.py sets
+# it (and clears it on start); unset, as for a single process, each process
+# keeps its metrics to itself and nothing carries over between runs
+metrics = Metrics(
+    directory=os.getenv("METRICS_DIR", ""),
+    flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+)
+
+# BM25 index over each pair's query and answer text. Postings hold precomputed
+# per-document weights, so scoring a question only touches documents that
+# share a term with it
+class LexicalIndex:
+    STOPWORDS = frozenset(
+        "a an and are at be by can do does for from have how i in is it me my "
+        "of on or our the their there these they this to what when where which "
+        "who why will with you your".split()
+    )
+    
+    def __init__(self, queries, answers, k1=1.5, b=0.75):
+        self.size = len(queries)
+        self.query_terms = [set(self.tokenize(query)) for query in queries]
+        counts = {}  # term -> {document: term frequency}
+        lengths = np.zeros(self.size, dtype=np.float32)
+        for doc, (query, answer) in enumerate(zip(queries, answers)):
+            terms = self.tokenize(query + " " + answer)
+            lengths[doc] = len(terms)
+            for term in terms:
+                counts.setdefault(term, {})
+                counts[term][doc] = counts[term].get(doc, 0) + 1
+        
+        norms = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0)) if self.size else lengths
+        self.postings = {}
+        for term, docs in counts.items():
+            ids = np.fromiter(docs.keys(), dtype=np.int64, count=len(docs))
+            tf = np.fromiter(docs.values(), dtype=np.float32, count=len(docs))
+            idf = math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            self.postings[term] = (ids, (idf * tf * (k1 + 1) / (tf + norms[ids])).astype(np.float32))
+    
+    @classmethod
+    def tokenize(cls, text):
+        return [term for term in re.findall(r"[a-z0-9]+", text.lower()) if term not in cls.STOPWORDS]
+    
+    def scores(self, text):
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(self.tokenize(text)):
+            if term in self.postings:
+                ids, weights = self.postings[term]
+                scores[ids] += weights
+        return scores
+    
+    def best_match(self, text, scores, candidates=5):
+        # Among the top BM25 hits, the stored query whose terms overlap the
+        # question's the most (Jaccard), and that overlap
+        terms = set(self.tokenize(text))
+        best, overlap = None, 0.0
+        # Only documents with a score: a scoped search zeroes the rest
+        ids = np.flatnonzero(scores)
+        if not terms or not len(ids):
+            return best, overlap
+        candidates = min(candidates, len(ids))
+        for doc in ids[np.argpartition(-scores[ids], candidates - 1)[:candidates]]:
+            stored = self.query_terms[doc]
+            similarity = len(terms & stored) / len(terms | stored)
+            if similarity > overlap:
+                best, overlap = int(doc), similarity
+        return best, overlap
+
+# Inverted-file (IVF) approximate nearest-neighbour index: spherical k-means
+# splits the normalised embeddings into clusters, and a question is only
+# scored against the rows of its nprobe closest clusters
+class IVFIndex:
+    def __init__(self, embeddings, nlist=None, nprobe=8, iterations=10, seed=0):
+        size = len(embeddings)
+        self.nlist = max(1, min(size, nlist or int(4 * math.sqrt(size))))
+        self.nprobe = max(1, min(nprobe, self.nlist))
+        
+        rng = np.random.default_rng(seed)
+        self.centroids = np.array(embeddings[rng.choice(size, self.nlist, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assignment = self._assign(embeddings)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignment, embeddings)
+            # Empty clusters keep their previous centroid
+            filled = np.bincount(assignment, minlength=self.nlist) > 0
+            self.centroids[filled] = normalize(sums[filled])
+        
+        assignment = self._assign(embeddings)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(self.nlist + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.nlist)]
+    
+    def _assign(self, embeddings, chunk=8192):
+        # Nearest centroid per row, in chunks to bound the score matrix
+        assignment = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), chunk):
+            assignment[start:start + chunk] = np.argmax(embeddings[start:start + chunk] @ self.centroids.T, axis=1)
+        return assignment
+    
+    def candidates(self, question_embeddings):
+        # Row ids in each question's nprobe closest clusters
+        scores = np.atleast_2d(question_embeddings) @ self.centroids.T
+        probes = np.argpartition(-scores, self.nprobe - 1, axis=1)[:, :self.nprobe]
+        return [np.concatenate([self.lists[c] for c in row]) for row in probes]
+
+# On-disk cache of query embeddings, keyed by model name and a content hash of
+# each query string. Each matrix is written once under a name derived from its
+# keys and memory-mapped on load, so workers share the pages via the OS cache
+class EmbeddingCache:
+    VERSION = 1
+    
+    def __init__(self, directory, model_name):
+        self.directory = directory
+        self.prefix = f"embeddings-v{self.VERSION}-{re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)}"
+        self.index_path = os.path.join(directory, self.prefix + ".json")
+    
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+    
+    @contextlib.contextmanager
+    def locked(self):
+        # Held while building a matrix, so when every worker reloads the same
+        # edit one of them encodes it and the others map what it saved
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            lock = open(os.path.join(self.directory, self.prefix + ".lock"), "a")
+        except OSError as e:
+            print(f"Error locking embedding cache: {e}")
+            yield
+            return
+        with lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+    
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            matrix = np.load(os.path.join(self.directory, index["file"]), mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return [], None
+        if index.get("version") != self.VERSION or matrix.shape[0] != len(index["keys"]):
+            return [], None
+        return index["keys"], np.asarray(matrix)
+    
+    def save(self, keys, matrix):
+        digest = hashlib.sha1("\n".join(keys).encode("utf-8")).hexdigest()[:16]
+        filename = f"{self.prefix}-{digest}.npy"
+        path = os.path.join(self.directory, filename)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to temporary files and rename so a concurrently booting
+            # worker never maps a half-written matrix
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, matrix)
+            os.replace(tmp, path)
+            tmp = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"version": self.VERSION, "file": filename, "keys": keys}, f)
+            os.replace(tmp, self.index_path)
+            
+            # Drop matrices from older corpora; mapped files stay readable
+            # until the processes using them let go
+            for name in os.listdir(self.directory):
+                if name.startswith(self.prefix + "-") and name.endswith(".npy") and name != filename:
+                    os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            print(f"Error writing embedding cache: {e}")
+
+def quantize(embeddings, dtype):
+    # Compact copy of a normalised float32 matrix for scoring. int8 keeps a
+    # per-row scale so row * scale approximates the original; float16 and
+    # float32 need none
+    if dtype == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        matrix = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return matrix, scales.astype(np.float32)
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+    return embeddings, None
+
+# One version of the corpus: the pairs as parallel tuples, their lexical index
+# and the embedding matrix, which load() attaches once the model is up. A
+# reload builds a new one and swaps it in, so a query that picked up a
+# version sees it consistently until it finishes
+class KnowledgeIndex:
+    _versions = itertools.count()
+    
+    def __init__(self, qa_pairs, hybrid=False):
+        # Parallel tuples rather than a list of dicts: one entry per pair, and
+        # the few distinct source names are shared rather than repeated
+        self.version = next(self._versions)
+        self.queries = tuple(qa["query"] for qa in qa_pairs)
+        self.answers = tuple(qa["answer"] for qa in qa_pairs)
+        self.sources = tuple(sys.intern(qa.get("source") or "") for qa in qa_pairs)
+        self.keys = [EmbeddingCache.key(query) for query in self.queries]
+        self.lexical = LexicalIndex(self.queries, self.answers) if hybrid else None
+        self.embeddings = None
+        self.scales = None
+        self.vectors = None  # The float32 rows embeddings was quantized from
+        self.ann = None
+        
+        # Shards by the optional city and location (one name or a list) on
+        # each pair: ("", "") is the global shard, (city, "") the pairs about
+        # a whole city and (city, location) one outlet's
+        shards = {}
+        for i, qa in enumerate(qa_pairs):
+            city = qa.get("city") or ""
+            locations = qa.get("location") or [""]
+            for location in [locations] if isinstance(locations, str) else locations:
+                shards.setdefault((city, location if city else ""), []).append(i)
+        self.shards = {scope: np.array(ids, dtype=np.int64) for scope, ids in shards.items()}
+        self.cities = {city for city, _ in self.shards if city}
+        # Normalised city and outlet names, to spot questions about another
+        # place than the caller's
+        self.places = {}
+        for city, location in self.shards:
+            if city:
+                self.places[normalize_question(city)] = (city, "")
+            if location:
+                self.places[normalize_question(location)] = (city, location)
+        self._routes = {}
+    
+    def scope_for(self, text, scope):
+        # The scope a normalised question is answered in. An unknown city
+        # searches everything and an unknown outlet the whole city, so only
+        # scopes built from the shards are routed. A question naming another
+        # outlet or city than the caller's is answered for that one, or for
+        # everything when it names several
+        if scope is None or scope[0] not in self.cities:
+            return None
+        city, location = scope
+        if (city, location) not in self.shards:
+            location = ""
+        padded = f" {text} "
+        named = [place for name, place in self.places.items() if f" {name} " in padded]
+        outlets = {place for place in named if place[1]}
+        cities = {place[0] for place in named}
+        if len(outlets) == 1:
+            return outlets.pop()
+        if outlets or (cities and city not in cities):
+            return (cities.pop(), "") if len(cities) == 1 else None
+        return city, location
+    
+    def route(self, scope):
+        # Row ids a question in scope (city, location) is scored against: the
+        # global shard, the city's and the outlet's, or with no location every
+        # outlet in the city. Sorted, so ties break as in a full search. Only
+        # scope_for()'s scopes reach it, so the memo is bounded by the shards
+        ids = self._routes.get(scope)
+        if ids is None:
+            city, location = scope
+            parts = [ids for (shard_city, shard_location), ids in self.shards.items()
+                     if shard_city == "" or (shard_city == city and (not location or shard_location in ("", location)))]
+            ids = self._routes[scope] = np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        return ids
+    
+    def rows(self):
+        # Float32 embedding rows by key, for the next version to reuse
+        if self.vectors is None:
+            return {}
+        return dict(zip(self.keys, self.vectors))
+
 class KnowledgeBase:
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.qa_pairs = self._load_qa_pairs()
-        self.qa_embeddings = self._compute_embeddings()
+    def __init__(self, model_name='all-MiniLM-L6-v2', model=None, qa_pairs=None, directory=None):
+        # The model and embeddings are loaded by load(), not here, so that
+        # importing the app doesn't wait on torch. A ready-made model (any
+        # object with encode() and get_sentence_embedding_dimension()) and a
+        # list of pairs can be passed in instead, e.g. by the benchmarks
+        self.model_name = model_name
+        self.model = model
+        self.embedding_dtype = os.getenv("KB_EMBEDDING_DTYPE", "float32")
+        self._ready = threading.Event()
+        self._load_lock = threading.Lock()
+        self.batch_size = int(os.getenv("KB_BATCH_SIZE", "32"))
+        # Repeated questions skip the model: one cache for question embeddings
+        # and one for final answers, both keyed by the normalised question
+        cache_size = int(os.getenv("KB_QUERY_CACHE_SIZE", "1024"))
+        cache_ttl = float(os.getenv("KB_QUERY_CACHE_TTL", "3600"))
+        self.embedding_cache = LRUCache(cache_size, cache_ttl)
+        self.answer_cache = LRUCache(cache_size, cache_ttl)
+        cache_dir = os.getenv("KB_EMBEDDING_CACHE", ".kb_cache")
+        self.cache = EmbeddingCache(cache_dir, model_name) if cache_dir else None
         
+        # Hybrid retrieval adds a BM25 signal to the dense ranking, which pins
+        # down outlet names, and answers near-verbatim matches of a stored
+        # question without running the model at all
+        self.hybrid = os.getenv("KB_RETRIEVAL", "dense") == "hybrid"
+        self.lexical_weight = float(os.getenv("KB_LEXICAL_WEIGHT", "0.3"))
+        self.lexical_shortcut = float(os.getenv("KB_LEXICAL_SHORTCUT", "0.8"))
+        
+        # Exact search scores every pair; "ivf" switches to the approximate
+        # index and "auto" does so once the corpus reaches KB_ANN_THRESHOLD
+        self.ann_mode = os.getenv("KB_ANN", "auto")
+        self.ann_threshold = int(os.getenv("KB_ANN_THRESHOLD", "5000"))
+        self.ann_nprobe = int(os.getenv("KB_ANN_NPROBE", "8"))
+        
+        # The pairs come from the data files in KB_DIR unless given directly
+        self.directory = None if qa_pairs is not None else directory or os.getenv("KB_DIR", "knowledge")
+        self.signature = self._signature()
+        if qa_pairs is None:
+            qa_pairs = self._load_qa_pairs()
+        self.index = KnowledgeIndex(qa_pairs, self.hybrid)
+    
+    def load(self):
+        # Import and load the model and build the embedding matrix. Callers
+        # arriving while a load is in progress wait for it to finish
+        if self._ready.is_set():
+            return
+        with self._load_lock:
+            if self._ready.is_set():
+                return
+            if self.model is None:
+                from sentence_transformers import SentenceTransformer
+                self.model = SentenceTransformer(self.model_name)
+                if os.getenv("TORCH_THREADS_PER_WORKER"):
+                    # Set by gunicorn.conf.py when workers share the cores
+                    import torch
+                    torch.set_num_threads(int(os.getenv("TORCH_THREADS_PER_WORKER")))
+                # Inference only: freezing the weights means nothing writes to
+                # the parameter pages, so pre-forked workers keep sharing them
+                self.model.eval()
+                for parameter in self.model.parameters():
+                    parameter.requires_grad_(False)
+            self._embed(self.index, {})
+            self._ready.set()
+    
+    def load_in_background(self):
+        def run():
+            try:
+                self.load()
+            except Exception as e:
+                # Left unloaded; the next question retries the load
+                print(f"Error loading knowledge base: {e}")
+        threading.Thread(target=run, name="kb-loader", daemon=True).start()
+    
+    def is_ready(self):
+        return self._ready.is_set()
+    
+    def reload(self):
+        # Re-read the data files and swap in the new corpus. Only pairs whose
+        # question is new or changed are encoded, and queries already running
+        # finish on the version they started with
+        if self.directory is None:
+            return None
+        with self._load_lock:
+            signature = self._signature()
+            index = KnowledgeIndex(self._load_qa_pairs(), self.hybrid)
+            encoded = self._embed(index, self.index.rows()) if self._ready.is_set() else 0
+            self.index = index
+            self.signature = signature
+        # Cached answers are keyed by version; drop the old ones now rather
+        # than waiting for them to age out
+        self.answer_cache.clear()
+        print(f"Reloaded knowledge base: {len(index.queries)} pairs, {encoded} encoded")
+        return {"pairs": len(index.queries), "encoded": encoded, "version": index.version}
+    
+    def after_fork(self):
+        # A load or reload running in the parent when it forked holds the
+        # lock, and its thread doesn't exist in the child to release it
+        self._load_lock = threading.Lock()
+    
+    def watch(self, interval):
+        # Poll the data files and reload when any is added, removed or changed
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self._signature() != self.signature:
+                        self.reload()
+                except Exception as e:
+                    print(f"Error reloading knowledge base: {e}")
+        threading.Thread(target=run, name="kb-watcher", daemon=True).start()
+    
+    def _signature(self):
+        # Names, sizes and modification times of the data files
+        if self.directory is None:
+            return ()
+        try:
+            return tuple(sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in os.scandir(self.directory) if entry.name.endswith((".json", ".jsonl"))
+            ))
+        except OSError:
+            return ()
+    
     def _load_qa_pairs(self):
-        # Load the Q&A pairs from the knowledge base
-        qa_pairs = [
-            {
-                "query": "What are the veg starters available at Barbeque Nation?",
-                "answer": "The veg starters available are Grill Veg, Mushroom, Paneer, veg kebab, Cajun Spice Potato, and Pineapple.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What vegetarian dishes are served?",
-                "answer": "For vegetarian guests, we offer veg starters like Grill Veg, Mushroom, Paneer, veg kebab, Cajun Spice Potato, and Pineapple; main courses such as Noodles, Oriental Veg, Paneer, Aloo, Veg Kofta, Veg Dry & Gravy, Dal Tadka, Dal Makhani, Veg Biryani, and Rice; and desserts including Angori Gulab Jamun, Phirnee, Ice Cream, Pie/tart, Fruits, Pastry, Brownie, and Pudding/soufflé. We also have veg soups and salads.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Can I get Jain food at Barbeque Nation, and what type of fish do you serve?",
-                "answer": "Yes, Jain food is available, but the variety is limited. We serve Basa fish, which is boneless.",
-                "source": "Menu and Drinks _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What flavors of kulfi do you serve at Barbeque Nation?",
-                "answer": "We serve six flavors of kulfi: Strawberry, Malai, Chocolate, Kesar Badam, Paan, and Mango.",
-                "source": "Menu and Drinks _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What non-veg starters are available that are not seafood?",
-                "answer": "The non-veg starters available that are not seafood are Chicken Tangdi, Chicken Skewer, and Mutton.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What is the address of the Barbeque Nation outlet in Indiranagar, Bangalore?",
-                "answer": "The address is No.4005, HAL 2nd Stage, 100 Feet Road, Indiranagar, Bangalore-560038.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the Indiranagar outlet have these facilities?",
-                "answer": "Yes, the Indiranagar outlet has a bar and baby chairs available.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "For the Indiranagar outlet, what are the lunch timings on Saturday, and do they offer complimentary drinks?",
-                "answer": "On Saturday, the lunch session at the Indiranagar outlet opens at 12:00 PM, with last entry at 3:00 PM, and closes at 4:00 PM. Yes, they offer complimentary drinks for lunch from Monday to Saturday, which includes 1 round of soft drink or mocktail.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the JP Nagar outlet have baby chairs?",
-                "answer": "Yes, the JP Nagar outlet has baby chairs available.",
-                "source": "Bangalore _ JP Nagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "For the JP Nagar outlet, what is the address, and do they have a bar?",
-                "answer": "The address of the JP Nagar outlet is 67, 3rd Floor, 6th B Main, Phase III, J P Nagar, Bengaluru, Karnataka 560078, India. Yes, they have a bar available.",
-                "source": "Bangalore _ JP Nagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What parking facilities does the Electronic City outlet offer?",
-                "answer": "The Electronic City outlet offers self or chargeable parking.",
-                "source": "Bangalore _ Electronic City _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What are the dinner timings for the Koramangala 1st Block outlet on Sunday?",
-                "answer": "The dinner session at the Koramangala 1st Block outlet opens at 6:30 PM, with last entry at 10:00 PM, and closes at 11:00 PM.",
-                "source": "Bangalore _ Koramangala 1st Block _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What are the dinner timings for the Connaught Place outlet in New Delhi?",
-                "answer": "The dinner session at the Connaught Place outlet opens at 6:30 PM, with last entry at 10:00 PM, and closes at 11:00 PM.",
-                "source": "New Delhi - Connaught Place _ CP _ cp _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Is the Vasant Kunj outlet suitable?",
-                "answer": "Yes, the Sector C, Vasant Kunj outlet has a bar available.",
-                "source": "New Delhi - Sector C, Vasant Kunj _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What are the dinner timings, and is there a bar available?",
-                "answer": "The dinner session at the Sector C, Vasant Kunj outlet opens at 6:30 PM, with last entry at 10:00 PM, and closes at 11:00 PM. Yes, there is a bar available.",
-                "source": "New Delhi - Sector C, Vasant Kunj _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the Unity Mall, Janakpuri outlet have a private dining room?",
-                "answer": "No, the Unity Mall, Janakpuri outlet does not have a private dining room available.",
-                "source": "New Delhi - Unity Mall, Janakpuri _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Which Bangalore outlets have valet parking, and do they all have the same menu?",
-                "answer": "The Bangalore outlets in Indiranagar, JP Nagar, and Koramangala 1st Block have parking assistance for valet parking, while the Electronic City outlet has self or chargeable parking. Yes, all outlets have the same standard menu.",
-                "source": "Outlet-specific documents and Menu and Drinks _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Specifically, do both have baby chairs and lifts?",
-                "answer": "Both the Indiranagar and Koramangala 1st Block outlets have baby chairs and lift availability.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf and Bangalore _ Koramangala 1st Block _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Which New Delhi outlets have valet parking, and do any of them offer early bird discounts?",
-                "answer": "The Connaught Place and Sector C, Vasant Kunj outlets have parking assistance for valet parking, while the Unity Mall, Janakpuri outlet has self/mall parking/chargeable. None of the New Delhi outlets offer early bird discounts.",
-                "source": "Outlet-specific documents"
-            },
-            {
-                "query": "Compare the facilities at the Electronic City and Koramangala outlets in Bangalore. Which one has better parking options?",
-                "answer": "The Electronic City outlet has self or chargeable parking, while the Koramangala 1st Block outlet has parking assistance. Therefore, the Koramangala outlet has better parking options with assistance.",
-                "source": "Bangalore _ Electronic City _ Barbeque Nation.pdf and Bangalore _ Koramangala 1st Block _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What non-veg main course options are available at Barbeque Nation?",
-                "answer": "The non-veg main course options include Chicken, Mutton, Fish, Noodles, Oriental Non-Veg, and Non-Veg Biryani.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What desserts do you offer?",
-                "answer": "We offer a variety of desserts including Angori Gulab Jamun, Phirnee, Ice Cream, Pie/Tart, Fruits, Pastry, Brownie, and Pudding/Soufflé.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Do you serve soups and salads at Barbeque Nation, and are they vegetarian?",
-                "answer": "Yes, we serve soups and salads at Barbeque Nation, and they are vegetarian options.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What types of drinks are available at Barbeque Nation?",
-                "answer": "We offer soft drinks, mocktails, and alcoholic beverages at outlets with a bar.",
-                "source": "Menu and Drinks _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What spicy dishes do you have on the menu?",
-                "answer": "For spicy food lovers, we have options like Cajun Spice Potato among the veg starters, and spicy variants of Chicken, Mutton, and Fish in the non-veg main courses.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the Indiranagar outlet in Bangalore have a lift?",
-                "answer": "Yes, the Indiranagar outlet has lift availability.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Is the JP Nagar outlet noisy?",
-                "answer": "The JP Nagar outlet is located on the 3rd floor of a building, which generally offers a quieter dining experience compared to street-level locations.",
-                "source": "Bangalore _ JP Nagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What is the seating capacity at the Electronic City outlet, and do they serve alcohol?",
-                "answer": "The seating capacity at the Electronic City outlet is not specified, but it follows standard Barbeque Nation sizing. Yes, they serve alcohol as there is a bar available.",
-                "source": "Bangalore _ Electronic City _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the Koramangala 1st Block outlet have a bar?",
-                "answer": "Yes, the Koramangala 1st Block outlet has a bar available.",
-                "source": "Bangalore _ Koramangala 1st Block _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Is the Indiranagar outlet good for families?",
-                "answer": "Yes, the Indiranagar outlet is family-friendly with baby chairs and lift availability.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the JP Nagar outlet have wheelchair access, and what are the dinner timings on Friday?",
-                "answer": "Yes, the JP Nagar outlet has wheelchair access via a lift. The dinner session on Friday opens at 6:30 PM, with last entry at 10:00 PM, and closes at 11:00 PM.",
-                "source": "Bangalore _ JP Nagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What is the contact number for the Electronic City outlet?",
-                "answer": "The contact number is not explicitly listed, but you can reach out via the central Barbeque Nation customer service or online booking system.",
-                "source": "Bangalore _ Electronic City _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Is the Koramangala 1st Block outlet usually crowded?",
-                "answer": "The Koramangala 1st Block outlet can get crowded due to its popular location, especially on weekends, but booking in advance can help manage this.",
-                "source": "Bangalore _ Koramangala 1st Block _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What is the seating capacity of the Connaught Place outlet?",
-                "answer": "The exact seating capacity isn't specified, but it follows Barbeque Nation's standard spacious layout suitable for large groups.",
-                "source": "New Delhi - Connaught Place _ CP _ cp _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What's the ambience like at the Vasant Kunj outlet?",
-                "answer": "The Sector C, Vasant Kunj outlet offers a modern and comfortable ambience, enhanced by its bar and spacious seating.",
-                "source": "New Delhi - Sector C, Vasant Kunj _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the Unity Mall, Janakpuri outlet have a lift, and do they offer mocktails?",
-                "answer": "Yes, the Unity Mall, Janakpuri outlet has a lift as it's in a mall. Yes, mocktails are available as part of the standard drink menu.",
-                "source": "New Delhi - Unity Mall, Janakpuri _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Can I book a table online for the Connaught Place outlet?",
-                "answer": "Yes, you can book a table online for the Connaught Place outlet through the Barbeque Nation website or app.",
-                "source": "General Barbeque Nation policy"
-            },
-            {
-                "query": "Is the Unity Mall, Janakpuri outlet suitable for a group of 15?",
-                "answer": "Yes, the Unity Mall, Janakpuri outlet is suitable for a group of 15 with its spacious seating, though it lacks a private dining room.",
-                "source": "New Delhi - Unity Mall, Janakpuri _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the Vasant Kunj outlet accept digital payments, and what are the lunch hours on Sunday?",
-                "answer": "Yes, the Sector C, Vasant Kunj outlet accepts digital payments. Lunch hours on Sunday are from 12:00 PM to 4:00 PM, with last entry at 3:00 PM.",
-                "source": "New Delhi - Sector C, Vasant Kunj _ Barbeque Nation.pdf"
-            },
-            # Adding more Q&A pairs from the dataset
-            {
-                "query": "Which Bangalore outlets have wheelchair access, and which one is easiest to reach?",
-                "answer": "The Indiranagar, JP Nagar, and Koramangala 1st Block outlets have wheelchair access via lifts. The Indiranagar outlet is easiest to reach due to its location on 100 Feet Road, a well-connected area.",
-                "source": "Outlet-specific documents"
-            },
-            {
-                "query": "Which New Delhi outlets have a bar, and which one has the largest seating capacity?",
-                "answer": "The Connaught Place and Sector C, Vasant Kunj outlets have bars. Connaught Place likely has the largest seating capacity due to its central, high-traffic location.",
-                "source": "Outlet-specific documents"
-            },
-            {
-                "query": "Which Bangalore outlets have baby chairs, and do they offer kid-friendly food?",
-                "answer": "The Indiranagar, JP Nagar, and Koramangala 1st Block outlets have baby chairs. Yes, all outlets offer kid-friendly food like Noodles, Ice Cream, and mild-flavored starters.",
-                "source": "Outlet-specific documents and Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Which New Delhi outlets are open on Sunday evenings, and do they get crowded?",
-                "answer": "All New Delhi outlets—Connaught Place, Sector C, Vasant Kunj, and Unity Mall, Janakpuri—are open on Sunday evenings from 6:30 PM to 11:00 PM. They can get crowded, especially Connaught Place, due to its popularity.",
-                "source": "Outlet-specific documents"
-            },
-            {
-                "query": "Which Bangalore outlets offer complimentary drinks, and what's included?",
-                "answer": "The Indiranagar, JP Nagar, and Koramangala 1st Block outlets offer complimentary drinks for lunch from Monday to Saturday, including 1 round of soft drink or mocktail. Electronic City follows the same policy.",
-                "source": "Outlet-specific documents"
-            },
-            {
-                "query": "Which New Delhi outlets are near metro stations, and do they have parking?",
-                "answer": "The Connaught Place outlet is near the Rajiv Chowk metro station and has valet parking. Unity Mall, Janakpuri is near the Janakpuri West metro station with self/mall parking. Vasant Kunj has valet parking but is farther from metro stations.",
-                "source": "Outlet-specific documents"
-            },
-            {
-                "query": "Are there any gluten-free options at Barbeque Nation?",
-                "answer": "Yes, gluten-free options include grilled items like Paneer, Chicken, and Fish, as well as salads and fruits. Please inform the staff for specific preparations.",
-                "source": "Menu List _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What's available for celebrations?",
-                "answer": "For celebrations, we offer a wide menu with starters, main courses, and desserts, plus a festive atmosphere. Some outlets have bars, and you can pre-book for groups.",
-                "source": "Menu and Drinks _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Can I customize my meal at Barbeque Nation, and what's the average cost per person?",
-                "answer": "Yes, you can request customizations like Jain food or spice levels, subject to availability. The average cost per person varies by outlet but typically ranges from ₹800-₹1200 for lunch/dinner.",
-                "source": "Menu and Drinks _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Do all Barbeque Nation outlets have live grills?",
-                "answer": "Yes, all Barbeque Nation outlets feature live grills at the table as part of the dining experience.",
-                "source": "General Barbeque Nation policy"
-            },
-            {
-                "query": "Do you offer takeaway options?",
-                "answer": "Yes, Barbeque Nation offers takeaway options from all outlets. You can order from the menu via phone or online.",
-                "source": "General Barbeque Nation policy"
-            },
-            {
-                "query": "What are the peak hours at the Indiranagar outlet?",
-                "answer": "Peak hours at the Indiranagar outlet are typically 1:00 PM - 2:30 PM for lunch and 7:30 PM - 9:30 PM for dinner, especially on weekends.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the JP Nagar outlet have a good view?",
-                "answer": "The JP Nagar outlet, located on the 3rd floor, offers a decent urban view of the surrounding area, though it's not a scenic highlight.",
-                "source": "Bangalore _ JP Nagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Is the Electronic City outlet noisy, and do they serve Basa fish?",
-                "answer": "The Electronic City outlet may have moderate noise due to its location in a busy tech area. Yes, Basa fish is served as part of the standard menu.",
-                "source": "Bangalore _ Electronic City _ Barbeque Nation.pdf and Menu and Drinks _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "What payment options are available at the Koramangala 1st Block outlet?",
-                "answer": "The Koramangala 1st Block outlet accepts cash, card, and digital payments like UPI.",
-                "source": "General Barbeque Nation policy"
-            },
-            {
-                "query": "What's the typical wait time at Indiranagar?",
-                "answer": "The wait time at Indiranagar varies but can be 15-30 minutes during peak hours without a reservation. Booking ahead reduces wait time.",
-                "source": "Bangalore _ Bengaluru - Indiranagar _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "How many waitstaff are typically at the Connaught Place outlet?",
-                "answer": "The Connaught Place outlet has a sufficient number of waitstaff to handle its busy crowd, though exact numbers aren't specified.",
-                "source": "New Delhi - Connaught Place _ CP _ cp _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Is the Vasant Kunj outlet quiet?",
-                "answer": "The Sector C, Vasant Kunj outlet offers a relatively quiet dining experience due to its location away from central bustle.",
-                "source": "New Delhi - Sector C, Vasant Kunj _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Does the Unity Mall, Janakpuri outlet have baby chairs, and what are the lunch hours on Saturday?",
-                "answer": "Yes, the Unity Mall, Janakpuri outlet has baby chairs. Lunch hours on Saturday are from 12:00 PM to 4:00 PM, with last entry at 3:00 PM.",
-                "source": "New Delhi - Unity Mall, Janakpuri _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Is the Connaught Place outlet noisy?",
-                "answer": "Yes, the Connaught Place outlet can be noisy due to its central location and high footfall, especially during peak hours.",
-                "source": "New Delhi - Connaught Place _ CP _ cp _ Barbeque Nation.pdf"
-            },
-            {
-                "query": "Can I make a reservation at the Vasant Kunj outlet?",
-                "answer": "Yes, you can make a reservation at the Sector C, Vasant Kunj outlet via the Barbeque Nation website or app.",
-                "source": "General Barbeque Nation policy"
-            },
-            {
-                "query": "Which Bangalore outlet is the most affordable, and do they all charge the same?",
-                "answer": "Pricing is generally consistent across Bangalore outlets—Indiranagar, JP Nagar, Electronic City, and Koramangala 1st Block—at around ₹800-₹1200 per person, though Electronic City might be slightly cheaper due to its location.",
-                "source": "General Barbeque Nation policy"
-            },
-            {
-                "query": "Which New Delhi outlet has the best atmosphere, and do they all have bars?",
-                "answer": "The Sector C, Vasant Kunj outlet offers the best atmosphere with a quieter, modern vibe. Only Connaught Place and Vasant Kunj have bars; Janakpuri does not.",
-                "source": "Outlet-specific documents"
-            },
-            {
-                "query": "Which Bangalore outlets allow online booking, and which is easiest to book?",
-                "answer": "All Bangalore outlets—Indiranagar, JP Nagar, Electronic City, and Koramangala 1st Block—allow online booking. Indiranagar is typically easiest due to its high availability and popularity.",
-                "source": "General Barbeque Nation policy"
-            },
-            {
-                "query": "Which New Delhi outlets are best for families, and do they have baby chairs?",
-                "answer": "The Sector C, Vasant Kunj and Unity Mall, Janakpuri outlets are best for families due to quieter settings and space. Both have baby chairs; Connaught Place does too but is noisier.",
-                "source": "Outlet-specific documents"
-            }
-        ]
-        return qa_pairs
-    
-    def _compute_embeddings(self):
-        embeddings = []
-        for qa in self.qa_pairs:
-            embedding = self.model.encode(qa["query"])
-            qa_with_embedding = qa.copy()
-            qa_with_embedding["embedding"] = embedding
-            embeddings.append(qa_with_embedding)
-        return embeddings
+        # Every .jsonl file (one pair per line) and .json file (a list of
+        # pairs) in the directory, in file name order. Each pair has a query,
+        # an answer and the source document it came from
+        qa_pairs = []
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError as e:
+            print(f"Error reading knowledge base directory: {e}")
+            return qa_pairs
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    if name.endswith(".jsonl"):
+                        for number, line in enumerate(f, 1):
+                            try:
+                                if line.strip():
+                                    qa_pairs.append(json.loads(line))
+                            except ValueError:
+                                print(f"Skipping unreadable knowledge base entry {path}:{number}")
+                    elif name.endswith(".json"):
+                        qa_pairs.extend(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Error reading knowledge base file {path}: {e}")
+        return [qa for qa in qa_pairs if isinstance(qa, dict) and qa.get("query") and qa.get("answer")]
+    
+    def _embed(self, index, previous):
+        # Attach the embedding matrix (and IVF index) to a corpus version,
+        # reusing the rows in previous; returns how many pairs were encoded
+        embeddings, encoded = self._compute_embeddings(index, previous)
+        if self.ann_mode == "ivf" or (self.ann_mode == "auto" and len(embeddings) >= self.ann_threshold):
+            index.ann = IVFIndex(embeddings, nprobe=self.ann_nprobe)
+        # KB_EMBEDDING_DTYPE=float16 or int8 keeps a half or quarter size
+        # matrix for scoring. The float32 one stays on the side so a reload
+        # only encodes new or changed questions, exactly; with the embedding
+        # cache on it is the mapped file, so it costs page cache rather than
+        # memory of each worker's own. Never modified afterwards, which keeps
+        # both copy-on-write friendly
+        index.embeddings, index.scales = quantize(embeddings, self.embedding_dtype)
+        index.embeddings.setflags(write=False)
+        index.vectors = embeddings
+        index.vectors.setflags(write=False)
+        return encoded
+    
+    def _compute_embeddings(self, index, previous):
+        if self.cache is None:
+            return self._build_embeddings(index, previous, [], None)
+        with self.cache.locked():
+            cached_keys, cached = self.cache.load()
+            return self._build_embeddings(index, previous, cached_keys, cached)
     
-    def query(self, question, threshold=0.6):
-        question_embedding = self.model.encode(question)
-        similarities = []
+    def _build_embeddings(self, index, previous, cached_keys, cached):
+        if cached is not None and cached_keys == index.keys:
+            return cached, 0
         
-        for qa in self.qa_embeddings:
-            similarity = np.dot(question_embedding, qa["embedding"])
-            similarities.append((similarity, qa))
+        # Keep every query embedding in one contiguous, L2-normalised float32
+        # matrix so a question is scored against all pairs in a single product.
+        # Only pairs that are new or changed since the cache was written (or
+        # since the previous version, on a reload) are encoded again
+        rows = dict(previous)
+        if cached is not None:
+            rows.update(zip(cached_keys, cached))
+        embeddings = np.empty(
+            (len(index.queries), self.model.get_sentence_embedding_dimension()),
+            dtype=np.float32
+        )
+        missing = []
+        for i, key in enumerate(index.keys):
+            row = rows.get(key)
+            if row is not None:
+                embeddings[i] = row
+            else:
+                missing.append(i)
+        embeddings[missing] = self.encode([index.queries[i] for i in missing])
         
-        # Sort by similarity score
-        similarities.sort(key=lambda x: x[0], reverse=True)
+        if self.cache:
+            # Use the saved file's mapping rather than this private copy, so
+            # pages are shared with the other workers after a reload too
+            self.cache.save(index.keys, embeddings)
+            saved_keys, saved = self.cache.load()
+            if saved is not None and saved_keys == index.keys:
+                embeddings = saved
+        return embeddings, len(missing)
+    
+    def encode(self, texts):
+        # Normalised embeddings for a list of strings, one row per string.
+        # sentence-transformers batches internally, so hand it the whole list
+        if not texts:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        start = time.perf_counter()
+        embeddings = normalize(self.model.encode(
+            list(texts), batch_size=self.batch_size, show_progress_bar=False
+        ))
+        metrics.since("kb_encode", start)
+        return embeddings
+    
+    def search(self, question_embeddings, k=1, lexical_scores=None, index=None, scope=None):
+        # Cosine similarity of each (normalised) question against every pair
+        # in one matrix product, or only against the IVF candidates when the
+        # approximate index is on, then the top k per question with
+        # argpartition rather than sorting the full list of scores. With a
+        # scope only its shards are scored, exactly; they are small
+        index = index or self.index
+        question_embeddings = np.atleast_2d(question_embeddings)
+        if scope is not None:
+            ids = index.route(scope)
+            candidates = [ids] * len(question_embeddings)
+            scores = self._similarities(index, question_embeddings, ids)
+        elif index.ann is not None:
+            candidates = index.ann.candidates(question_embeddings)
+            if lexical_scores is not None:
+                # Strong lexical hits are scored even if their cluster
+                # wasn't probed
+                candidates = [
+                    np.union1d(ids, np.flatnonzero(lexical)[np.argsort(-lexical[lexical > 0])[:10]])
+                    for ids, lexical in zip(candidates, lexical_scores)
+                ]
+            scores = [self._similarities(index, question[None], ids)[0] for ids, question in zip(candidates, question_embeddings)]
+        else:
+            candidates = [None] * len(question_embeddings)
+            scores = self._similarities(index, question_embeddings)
         
-        # Return the most similar answer if above threshold
-        if similarities[0][0] >= threshold:
+        results = []
+        for i, (ids, row) in enumerate(zip(candidates, scores)):
+            ranking = row
+            if lexical_scores is not None:
+                # Hybrid: rank by cosine similarity plus the question's BM25
+                # scores scaled to [0, 1]; the reported score stays the cosine
+                lexical = lexical_scores[i]
+                peak = lexical.max() or 1.0
+                ranking = row + self.lexical_weight * (lexical if ids is None else lexical[ids]) / peak
+            top = min(k, len(row))
+            top = np.argpartition(-ranking, top - 1)[:top]
+            top = top[np.argsort(-ranking[top])]
+            results.append([(int(j if ids is None else ids[j]), float(row[j])) for j in top])
+        return results
+    
+    def _similarities(self, index, question_embeddings, ids=None, chunk=4096):
+        # Scores of each question against all stored rows, or just the given
+        # row ids. Quantized rows are widened to float32 a chunk at a time so
+        # the temporary copy stays small, then int8 scores are rescaled
+        matrix = index.embeddings if ids is None else index.embeddings[ids]
+        if matrix.dtype == np.float32:
+            return question_embeddings @ matrix.T
+        scores = np.empty((len(question_embeddings), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), chunk):
+            block = matrix[start:start + chunk].astype(np.float32)
+            scores[:, start:start + chunk] = question_embeddings @ block.T
+        if index.scales is not None:
+            scores *= index.scales if ids is None else index.scales[ids]
+        return scores
+    
+    def _answer(self, index, best, confidence, threshold, match="dense"):
+        # Return the most similar answer if above threshold. "match" says what
+        # the confidence measures: "dense" is the cosine similarity of the
+        # embeddings, "lexical" the Jaccard overlap of the question's terms
+        # with the stored question's (the hybrid shortcut, which never runs
+        # the model)
+        if confidence >= threshold:
             return {
-                "answer": similarities[0][1]["answer"],
-                "source": similarities[0][1]["source"],
-                "confidence": similarities[0][0]
+                "answer": index.answers[best],
+                "source": index.sources[best],
+                "confidence": confidence,
+                "match": match
             }
         else:
+            metrics.inc("kb_low_confidence")
             return {
                 "answer": "I'm sorry, I don't have enough information to answer that question accurately. Would you like to speak with a customer service representative?",
                 "source": None,
-                "confidence": similarities[0][0]
+                "confidence": confidence,
+                "match": match
             }
+    
+    def query(self, question, threshold=0.6, scope=None):
+        return self.query_many([question], threshold, scope)[0]
+    
+    def cached_answer(self, question, threshold=0.6, scope=None):
+        # The cached answer, if any, without running anything
+        answer = self.answer_cache.get((normalize_question(question), threshold, self.index.version, scope), count_miss=False)
+        return dict(answer) if answer is not None else None
+    
+    def query_many(self, questions, threshold=0.6, scope=None):
+        # Answer a list of questions with the same threshold and scope. A
+        # scope (city, location) limits the answers to those shards; None
+        # searches everything
+        return self.answer_many([(question, threshold, scope) for question in questions])
+    
+    def answer_many(self, requests):
+        # Answer (question, threshold, scope) requests together. Cached answers
+        # are returned straight away; every other distinct question is encoded
+        # once, a batch at a time so the score matrix stays small for large
+        # backlogs, whatever scopes it was asked in, and then scored against
+        # each of those scopes' shards
+        index = self.index
+        answers = [None] * len(requests)
+        pending = {}  # (normalised question, threshold, scope) -> positions waiting on it
+        originals = {}  # normalised question -> one way it was asked
+        for i, (question, threshold, scope) in enumerate(requests):
+            text = normalize_question(question)
+            scope = index.scope_for(text, scope)
+            cached = self.answer_cache.get((text, threshold, index.version, scope))
+            if cached is not None:
+                answers[i] = dict(cached)
+            else:
+                pending.setdefault((text, threshold, scope), []).append(i)
+                originals.setdefault(text, question)
+        
+        def resolve(key, answer):
+            text, threshold, scope = key
+            self.answer_cache.put((text, threshold, index.version, scope), answer)
+            for i in pending[key]:
+                answers[i] = dict(answer)
+        
+        keys = list(pending)
+        lexical_scores = {}
+        if index.lexical is not None:
+            text_scores = {}
+            for key in keys:
+                text, threshold, scope = key
+                scores = text_scores.get(text)
+                if scores is None:
+                    scores = text_scores[text] = index.lexical.scores(text)
+                if scope is not None:
+                    ids = index.route(scope)
+                    scoped = np.zeros_like(scores)
+                    scoped[ids] = scores[ids]
+                    scores = scoped
+                best, overlap = index.lexical.best_match(text, scores)
+                if best is not None and overlap >= max(self.lexical_shortcut, threshold):
+                    resolve(key, self._answer(index, best, overlap, threshold, match="lexical"))
+                else:
+                    lexical_scores[key] = scores
+            keys = list(lexical_scores)
+        
+        if keys:
+            self.load()
+            if index.embeddings is None:
+                # Replaced by a reload before the model was up; use the new one
+                return self.answer_many(requests)
+            searchable = []
+            for key in keys:
+                if not index.queries or (key[2] is not None and not len(index.route(key[2]))):
+                    resolve(key, self._answer(index, None, 0.0, key[1]))
+                else:
+                    searchable.append(key)
+            keys = searchable
+        
+        texts = list(dict.fromkeys(text for text, _, _ in keys))
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            embeddings = dict(zip(batch, self._question_embeddings(batch, [originals[text] for text in batch])))
+            scopes = {}
+            for key in keys:
+                if key[0] in embeddings:
+                    scopes.setdefault(key[2], []).append(key)
+            scored = time.perf_counter()
+            for scope, group in scopes.items():
+                lexical = np.stack([lexical_scores[key] for key in group]) if lexical_scores else None
+                results = self.search(
+                    np.stack([embeddings[text] for text, _, _ in group]),
+                    lexical_scores=lexical, index=index, scope=scope
+                )
+                for key, matches in zip(group, results):
+                    resolve(key, self._answer(index, *matches[0], key[1]))
+            metrics.since("kb_similarity", scored)
+        return answers
+    
+    def _question_embeddings(self, keys, questions):
+        # Reuse cached question embeddings and only run the model on the rest
+        embeddings = [self.embedding_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            for i, embedding in zip(missing, self.encode([questions[i] for i in missing])):
+                self.embedding_cache.put(keys[i], embedding)
+                embeddings[i] = embedding
+        return np.stack(embeddings)
+    
+    def cache_stats(self):
+        return {
+            "embeddings": self.embedding_cache.stats(),
+            "answers": self.answer_cache.stats()
+        }
 
-# Initialize knowledge base
+# Initialize knowledge base. Most turns are menu navigation that never touches
+# it, so by default the model loads in a background thread while the app starts
+# serving; only knowledge queries arriving before it is ready wait for it.
+# "eager" loads during import (used when Gunicorn preloads the app before
+# forking) and "lazy" defers loading until the first question
 kb = KnowledgeBase()
+kb_scoped = os.getenv("KB_SCOPED", "1") == "1"
+kb_load_mode = os.getenv("KB_LOAD_MODE", "background")
+if kb_load_mode == "eager":
+    kb.load()
+elif kb_load_mode == "background":
+    kb.load_in_background()
 
-# Google Sheets logger
-class SheetLogger:
-    def __init__(self):
+# KB_WATCH_INTERVAL seconds between checks of the data files for changes (0
+# turns it off). Each worker runs its own watcher, so all of them pick up an
+# edit; the admin endpoint reloads only the worker that serves it. Only the
+# first to reload encodes the change, the rest map the matrix it cached. A
+# preloading Gunicorn master serves nothing, so gunicorn.conf.py sets
+# KB_WATCH_WORKERS_ONLY=1 and only the forked workers watch
+kb_watch_interval = float(os.getenv("KB_WATCH_INTERVAL", "5"))
+if kb_watch_interval > 0 and os.getenv("KB_WATCH_WORKERS_ONLY") != "1":
+    kb.watch(kb_watch_interval)
+
+def kb_after_fork():
+    kb.after_fork()
+    if kb_watch_interval > 0:
+        kb.watch(kb_watch_interval)
+
+os.register_at_fork(after_in_child=kb_after_fork)
+
+# Coalesces questions from concurrent requests into one query_many call, so
+# a burst costs one batched encode instead of one forward pass per caller.
+# The first question waits at most max_wait seconds for company, and a batch
+# goes as soon as it reaches max_batch questions. Cached answers skip it
+class QueryBatcher:
+    def __init__(self, kb, max_batch=32, max_wait=0.005):
+        self.kb = kb
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    def _ensure_worker(self):
+        # Started on first use in each process; threads don't survive a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue()
+                threading.Thread(target=self._run, name="kb-batcher", daemon=True).start()
+                self._pid = os.getpid()
+    
+    def submit(self, question, threshold=0.6, scope=None):
+        future = Future()
+        answer = self.kb.cached_answer(question, threshold, scope)
+        if answer is not None:
+            future.set_result(answer)
+            return future
+        self._ensure_worker()
+        self.queue.put((question, threshold, scope, future))
+        return future
+    
+    def query(self, question, threshold=0.6, scope=None):
+        return self.submit(question, threshold, scope).result()
+    
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # One call for the whole window, so each distinct question is
+            # encoded once whichever outlet's caller asked it
+            try:
+                answers = self.kb.answer_many([(question, threshold, scope) for question, threshold, scope, _ in items])
+            except Exception as e:
+                for *_, future in items:
+                    future.set_exception(e)
+                continue
+            for (*_, future), answer in zip(items, answers):
+                future.set_result(answer)
+
+# KB_MICROBATCH=0 sends each question to the knowledge base on its own
+query_batcher = None
+if os.getenv("KB_MICROBATCH", "1") == "1":
+    query_batcher = QueryBatcher(
+        kb,
+        max_batch=int(os.getenv("KB_MICROBATCH_SIZE", "32")),
+        max_wait=float(os.getenv("KB_MICROBATCH_WAIT_MS", "5")) / 1000
+    )
+
+# Append-only spool of log records, one JSON line each, plus the byte offset
+# of the last record the sink acknowledged. Every record lands here before it
+# is sent anywhere, so nothing is lost while Sheets is slow or down
+class LogSpool:
+    def __init__(self, path, max_bytes=1 << 20):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        
+        # Terminate a line torn by a crash so new records start cleanly
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell():
+            self._file.seek(-1, os.SEEK_END)
+            if self._file.read(1) != b"\n":
+                self._file.write(b"\n")
+                self._file.flush()
+        self._file.seek(0, os.SEEK_END)
+        self.written = self.synced = self._file.tell()
+        
         try:
+            with open(self.offset_path) as f:
+                self.acked = int(f.read() or 0)
+        except (OSError, ValueError):
+            self.acked = 0
+        if self.acked > self.written:
+            # Crashed between truncating the spool and resetting the offset
+            self.acked = 0
+    
+    def append(self, record):
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.written += len(line)
+    
+    def sync(self):
+        # One fsync covers every record appended since the last one
+        end = self.written
+        if end > self.synced:
+            os.fsync(self._file.fileno())
+            self.synced = end
+    
+    def read(self, limit):
+        # Up to limit synced records after the acknowledged offset, and the
+        # offset just past them
+        records = []
+        offset = self.acked
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while len(records) < limit and offset < self.synced:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"Skipping unreadable log spool record in {self.path}")
+        return records, offset
+    
+    def ack(self, offset):
+        with self._lock:
+            if offset == self.written and self.written >= self.max_bytes:
+                # Everything is delivered: start the spool over rather than
+                # letting it grow without bound
+                self._file.truncate(0)
+                os.fsync(self._file.fileno())
+                self.written = self.synced = offset = 0
+            tmp = f"{self.offset_path}.tmp"
+            with open(tmp, "w") as f:
+                f.write(str(offset))
+            os.replace(tmp, self.offset_path)
+            self.acked = offset
+    
+    def backlog(self):
+        return self.written - self.acked
+    
+    def close(self):
+        self._file.close()
+
+# Log sinks. write_rows() stores a batch of [timestamp, phone, outcome,
+# summary] rows or raises, in which case the batch is retried later
+class SheetsSink:
+    def __init__(self, spreadsheet="BBQ Nation Logs", credentials="credentials.json"):
+        self.spreadsheet = spreadsheet
+        self.credentials = credentials
+        self.sheet = None
+        self._pid = None
+    
+    def _connect(self):
+        # Connect on first write in each process, so that workers forked from
+        # a preloading master never share the master's HTTPS session
+        if self._pid != os.getpid():
             scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-            creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
+            creds = ServiceAccountCredentials.from_json_keyfile_name(self.credentials, scope)
             self.client = gspread.authorize(creds)
-            self.sheet = self.client.open("BBQ Nation Logs").sheet1
-            self.initialized = True
-        except Exception as e:
-            print(f"Error initializing Google Sheets: {e}")
-            self.initialized = False
+            self.sheet = self.client.open(self.spreadsheet).sheet1
+            self._pid = os.getpid()
+        return self.sheet
+    
+    def write_rows(self, rows):
+        self._connect().append_rows(rows)
+    
+    def __str__(self):
+        return "Google Sheets"
+
+# Connections to a SQLite file in WAL mode: one per thread, opened on first
+# use and opened again in a forked child rather than shared with the parent.
+# setup statements run on every new connection
+class SQLiteConnections:
+    def __init__(self, path, timeout=5, pragmas=(), setup=()):
+        self.path = path
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.setup = setup
+        self._local = threading.local()
+    
+    def connect(self):
+        if getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout)
+            db.execute("PRAGMA journal_mode=WAL")
+            for pragma in self.pragmas:
+                db.execute(f"PRAGMA {pragma}")
+            with db:
+                for statement in self.setup:
+                    db.execute(statement)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+# Local SQLite table; handles thousands of rows per second for high-volume
+# deployments. Only the logger's writer thread uses the connection
+class SQLiteSink:
+    def __init__(self, path="logs.db"):
+        self.path = path
+        self._db = SQLiteConnections(path, timeout=10, setup=(
+            "CREATE TABLE IF NOT EXISTS logs (timestamp TEXT, phone TEXT, outcome TEXT, summary TEXT)",
+        )).connect
+    
+    def write_rows(self, rows):
+        with self._db() as db:
+            db.executemany("INSERT INTO logs VALUES (?, ?, ?, ?)", rows)
+    
+    def __str__(self):
+        return f"SQLite ({self.path})"
+
+class CSVSink:
+    def __init__(self, path="logs.csv"):
+        self.path = path
+    
+    def write_rows(self, rows):
+        with open(self.path, "a", newline="") as f:
+            csv.writer(f).writerows(rows)
+    
+    def __str__(self):
+        return f"CSV ({self.path})"
+
+# Keeps rows in memory, optionally after a delay and with random failures, to
+# stand in for Sheets in tests and offline load tests
+class MemorySink:
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rows = []
+        self._random = random.Random(seed)
+    
+    def write_rows(self, rows):
+        if self.latency:
+            time.sleep(self.latency)
+        if self._random.random() < self.failure_rate:
+            raise RuntimeError("injected log sink failure")
+        self.rows.extend(rows)
+    
+    def __str__(self):
+        return "memory sink"
+
+def make_log_sink(name):
+    if name == "sqlite":
+        return SQLiteSink(os.getenv("LOG_SQLITE_PATH", "logs.db"))
+    if name == "csv":
+        return CSVSink(os.getenv("LOG_CSV_PATH", "logs.csv"))
+    if name == "memory":
+        return MemorySink(
+            latency=float(os.getenv("LOG_SINK_LATENCY_MS", "0")) / 1000,
+            failure_rate=float(os.getenv("LOG_SINK_FAILURE_RATE", "0"))
+        )
+    return SheetsSink()
+
+def log_row(data):
+    # The [timestamp, phone, outcome, summary] row a sink stores for an event
+    return [
+        data.get("timestamp", datetime.datetime.now().isoformat()),
+        data.get("phone", ""),
+        data.get("outcome", ""),
+        data.get("summary", "")[:50]  # Truncate to 50 chars
+    ]
+
+# Event logger. log() appends the row to this process's spool file and
+# returns; a background thread fsyncs the spool at most every
+# LOG_FSYNC_INTERVAL seconds and replays it to the sink once LOG_BATCH_SIZE
+# rows are waiting or every LOG_FLUSH_INTERVAL seconds. Failed replays back
+# off exponentially and rows stay spooled until the sink accepts them,
+# including across restarts
+class EventLogger:
+    def __init__(self, sink, spool_dir=None):
+        self.sink = sink
+        self.spool_dir = spool_dir or os.getenv("LOG_SPOOL_DIR", ".log_spool")
+        self.batch_size = int(os.getenv("LOG_BATCH_SIZE", "50"))
+        self.flush_interval = float(os.getenv("LOG_FLUSH_INTERVAL", "2"))
+        self.fsync_interval = float(os.getenv("LOG_FSYNC_INTERVAL", "0.05"))
+        self.orphan_interval = float(os.getenv("LOG_ORPHAN_SCAN_INTERVAL", "300"))
+        self.spool = None
+        self.unsent = 0
+        self._slot = None
+        self._worker = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start()
+        os.register_at_fork(after_in_child=self._start_in_child)
+        atexit.register(self.close)
+    
+    def _claim(self, slot):
+        # Each process owns one spool slot, held with an exclusive lock so a
+        # restarted worker picks up (and replays) whatever its predecessor
+        # left behind
+        lock = open(os.path.join(self.spool_dir, f"spool-{slot}.lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                return None
+        return lock
+    
+    def _start(self):
+        # Claim the first free spool slot and start the writer thread. It
+        # runs at once so a backlog left by a previous process is replayed
+        # even before anything new is logged
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.spool_dir, exist_ok=True)
+            slot = 0
+            while (lock := self._claim(slot)) is None:
+                slot += 1
+            self._slot = (slot, lock)
+            self.spool = LogSpool(os.path.join(self.spool_dir, f"spool-{slot}.jsonl"))
+            self.unsent = 1 if self.spool.backlog() else 0
+            self._worker = threading.Thread(target=self._run, name="sheet-logger", daemon=True)
+            self._worker.start()
+            self._pid = os.getpid()
+    
+    def _start_in_child(self):
+        # The writer thread doesn't survive a fork (e.g. Gunicorn preloading
+        # the app), so a forked worker takes its own slot and thread. The
+        # parent keeps its lock; closing our copies doesn't release it
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        if self._slot is not None:
+            self._slot[1].close()
+            self.spool.close()
+        self._pid = None
+        self._start()
     
     def log(self, data):
-        if not self.initialized:
-            print("Logger not initialized, skipping log")
-            return False
-        
         try:
-            self.sheet.append_row([
-                data.get("timestamp", datetime.datetime.now().isoformat()),
-                data.get("phone", ""),
-                data.get("outcome", ""),
-                data.get("summary", "")[:50]  # Truncate to 50 chars
-            ])
-            return True
-        except Exception as e:
-            print(f"Error logging to Google Sheets: {e}")
+            self.spool.append(log_row(data))
+        except (OSError, ValueError) as e:
+            print(f"Error writing log spool: {e}")
+            metrics.inc("log_failures", stage="spool")
             return False
+        self.unsent += 1
+        self._wake.set()
+        return True
+    
+    def _run(self):
+        delay = 0.0
+        last_replay = next_replay = time.monotonic()
+        next_orphan_scan = last_replay + self.orphan_interval
+        self._replay_orphans()
+        while True:
+            # Even when idle, wake up in time for the next orphan scan
+            idle = self.spool.backlog() == 0
+            until_scan = max(next_orphan_scan - time.monotonic(), 0.0)
+            self._wake.wait(until_scan if idle else min(until_scan, self.fsync_interval))
+            self._wake.clear()
+            stopping = self._stop.is_set()
+            self.spool.sync()
+            
+            now = time.monotonic()
+            due = self.unsent >= self.batch_size or now - last_replay >= self.flush_interval
+            if self.spool.backlog() and (stopping or (due and now >= next_replay)):
+                last_replay = now
+                if self._replay(self.spool):
+                    self.unsent = 0
+                    delay = 0.0
+                else:
+                    delay = min(delay * 2 or 1.0, 60.0)
+                    next_replay = now + delay
+            if stopping:
+                return
+            if now >= next_orphan_scan:
+                self._replay_orphans()
+                next_orphan_scan = now + self.orphan_interval
+            # Rows logged during the wait share the next fsync
+            self._stop.wait(self.fsync_interval)
+    
+    def _replay(self, spool):
+        # Send synced records in batches; False as soon as the sink fails
+        while spool.acked < spool.synced:
+            records, offset = spool.read(self.batch_size)
+            if records:
+                start = time.perf_counter()
+                try:
+                    self.sink.write_rows(records)
+                except Exception as e:
+                    print(f"Error logging to {self.sink}: {e}")
+                    metrics.inc("log_failures", stage="sink")
+                    return False
+                metrics.since("log_sink", start)
+            spool.ack(offset)
+        return True
+    
+    def _replay_orphans(self):
+        # Drain spools whose owner is gone and whose slot nobody reclaimed,
+        # e.g. after running with fewer workers than before
+        for name in os.listdir(self.spool_dir):
+            match = re.fullmatch(r"spool-(\d+)\.lock", name)
+            if not match or int(match.group(1)) == self._slot[0]:
+                continue
+            lock = self._claim(int(match.group(1)))
+            if lock is None:
+                continue
+            try:
+                spool = LogSpool(os.path.join(self.spool_dir, f"spool-{match.group(1)}.jsonl"))
+                self._replay(spool)
+                spool.close()
+            except OSError as e:
+                print(f"Error replaying log spool {name}: {e}")
+            finally:
+                lock.close()
+    
+    def close(self, timeout=10):
+        # Sync the spool and make a last attempt to deliver it before exit
+        if self._pid != os.getpid() or not self._worker.is_alive():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._worker.join(timeout)
+        if not self._worker.is_alive():
+            # Free the slot for the next process
+            self.spool.close()
+            self._slot[1].close()
 
 # Initialize logger
-logger = SheetLogger()
+# LOG_SINK picks the backend: sheets (default), sqlite, csv or memory
+logger = EventLogger(make_log_sink(os.getenv("LOG_SINK", "sheets")))
+
+# Reservations, held in memory and indexed by reference, by phone number and
+# by (outlet, date), so every lookup is a dict access however many bookings
+# there are. Changes are appended to a log on local disk and folded into a
+# snapshot every compact_every changes. Writers hold an exclusive flock and
+# catch up on the log first, so several worker processes can share one
+# directory; readers pick up other processes' changes from the log's tail,
+# and reload when compaction has replaced the log
+class BookingStore:
+    FIELDS = ("phone", "city", "location", "date", "time_slot", "guests")
+    ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    _open_stores = weakref.WeakSet()  # Reopened in forked children
+    
+    def __init__(self, directory, compact_every=10000):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.snapshot_path = os.path.join(directory, "bookings.json")
+        self.log_path = os.path.join(directory, "bookings.log")
+        self._lock = threading.RLock()
+        self._log = None
+        self._lockfile = None
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+        BookingStore._open_stores.add(self)
+    
+    def _open(self):
+        # Forked workers need their own open files: a shared description
+        # would share the flock and the read position with the parent
+        self._lock = threading.RLock()
+        if self._lockfile is not None:
+            self._lockfile.close()
+        self._lockfile = open(os.path.join(self.directory, "bookings.lock"), "a")
+        with self._locked(shared=True):
+            self._reload()
+    
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+    
+    def _reload(self):
+        # Rebuild everything from the snapshot and the current log
+        self.bookings = {}  # reference -> booking, cancelled ones included
+        self.by_phone = {}  # phone -> {reference: None} of confirmed bookings
+        self.by_outlet = {}  # (location, date) -> {reference: None} of confirmed bookings
+        try:
+            with open(self.snapshot_path) as f:
+                for booking in json.load(f):
+                    self._apply(booking)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print(f"Error reading booking snapshot: {e}")
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, "a+b")
+        self._log.seek(0)
+        self._pending = b""
+        self._entries = 0
+        self._read_log()
+    
+    def _read_log(self):
+        # Apply whole lines appended since the last read; a line still being
+        # written is kept for next time
+        data = self._pending + self._log.read()
+        end = data.rfind(b"\n") + 1
+        self._pending = data[end:]
+        for line in data[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+            except ValueError:
+                print(f"Skipping unreadable booking log entry in {self.log_path}")
+            self._entries += 1
+    
+    def _refresh(self, locked=False):
+        # Cheap when nothing changed: one stat of the log
+        try:
+            replaced = os.stat(self.log_path).st_ino != os.fstat(self._log.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if not replaced:
+            self._read_log()
+        elif locked:
+            self._reload()
+        else:
+            with self._locked(shared=True):
+                self._reload()
+    
+    def _apply(self, booking):
+        reference = booking["reference"]
+        old = self.bookings.get(reference)
+        if old is not None and old["status"] == "confirmed":
+            self.by_phone.get(old["phone"], {}).pop(reference, None)
+            self.by_outlet.get((old["location"], old["date"]), {}).pop(reference, None)
+        self.bookings[reference] = booking
+        if booking["status"] == "confirmed":
+            self.by_phone.setdefault(booking["phone"], {})[reference] = None
+            self.by_outlet.setdefault((booking["location"], booking["date"]), {})[reference] = None
+    
+    def _write(self, booking):
+        # Called holding the exclusive lock, caught up with the log. Anything
+        # left of a line then is torn by a crash; end it so ours reads cleanly
+        line = (json.dumps(booking) + "\n").encode("utf-8")
+        if self._pending:
+            line = b"\n" + line
+            self._pending = b""
+        self._log.write(line)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._apply(booking)
+        self._entries += 1
+        if self._entries >= self.compact_every:
+            self._compact()
+    
+    def _compact(self):
+        # New snapshot first, then an empty log in place of the old one; a
+        # reader that sees the new log therefore also sees the new snapshot
+        try:
+            tmp = f"{self.snapshot_path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(list(self.bookings.values()), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_path)
+            tmp = f"{self.log_path}.{os.getpid()}.tmp"
+            open(tmp, "wb").close()
+            os.replace(tmp, self.log_path)
+        except OSError as e:
+            print(f"Error compacting booking log: {e}")
+            return
+        self._log.close()
+        self._log = open(self.log_path, "a+b")
+        self._pending = b""
+        self._entries = 0
+    
+    def _change(self, reference, **changes):
+        with self._locked():
+            self._refresh(locked=True)
+            booking = self.bookings.get(reference)
+            if booking is None or booking["status"] != "confirmed":
+                return None
+            booking = dict(booking, **changes, updated=datetime.datetime.now().isoformat())
+            self._write(booking)
+            return dict(booking)
+    
+    def get(self, reference):
+        with self._lock:
+            self._refresh()
+            booking = self.bookings.get(reference)
+            return dict(booking) if booking is not None else None
+    
+    def find_by_phone(self, phone):
+        with self._lock:
+            self._refresh()
+            return [dict(self.bookings[reference]) for reference in self.by_phone.get(phone, ())]
+    
+    def find_by_outlet(self, location, date):
+        with self._lock:
+            self._refresh()
+            return [dict(self.bookings[reference]) for reference in self.by_outlet.get((location, date), ())]
+    
+    def create(self, details):
+        with self._locked():
+            self._refresh(locked=True)
+            reference = None
+            while reference is None or reference in self.bookings:
+                reference = "".join(secrets.choice(self.ALPHABET) for _ in range(6))
+            now = datetime.datetime.now().isoformat()
+            booking = {field: details.get(field, "") for field in self.FIELDS}
+            booking.update(reference=reference, status="confirmed", created=now, updated=now)
+            self._write(booking)
+            return dict(booking)
+    
+    def modify(self, reference, details):
+        return self._change(reference, **{field: details[field] for field in self.FIELDS if field in details})
+    
+    def cancel(self, reference):
+        return self._change(reference, status="cancelled")
+
+os.register_at_fork(after_in_child=lambda: [store._open() for store in list(BookingStore._open_stores)])
+
+# BOOKING_STORE_DIR holds the snapshot and log; every worker opens the same one
+booking_store = BookingStore(
+    os.getenv("BOOKING_STORE_DIR", ".bookings"),
+    compact_every=int(os.getenv("BOOKING_COMPACT_EVERY", "10000"))
+)
+
+# Seats left per (outlet, date, slot), as one small row of counters each in a
+# SQLite file shared by every worker. A reservation is a single conditional
+# UPDATE, so two callers racing for the last seats can't both get them; rows
+# are created on first use with the outlet's capacity
+class SlotStore:
+    def __init__(self, path="slots.db", capacity=80, capacities=None):
+        self.path = path
+        self.capacity = capacity
+        self.capacities = capacities or {}  # outlet -> seats per slot
+        self._db = SQLiteConnections(path, timeout=10, pragmas=("synchronous=NORMAL",)).connect
+        with self._db() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS slots (outlet TEXT, date TEXT, slot TEXT, capacity INTEGER, reserved INTEGER, "
+                "PRIMARY KEY (outlet, date, slot)) WITHOUT ROWID"
+            )
+    
+    def remaining(self, outlet, date, slot):
+        row = self._db().execute(
+            "SELECT capacity - reserved FROM slots WHERE outlet = ? AND date = ? AND slot = ?",
+            (outlet, date, slot)
+        ).fetchone()
+        return row[0] if row else self.capacities.get(outlet, self.capacity)
+    
+    def reserve(self, outlet, date, slot, seats):
+        # True if the seats were taken; a negative count gives seats back
+        with self._db() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO slots VALUES (?, ?, ?, ?, 0)",
+                (outlet, date, slot, self.capacities.get(outlet, self.capacity))
+            )
+            return db.execute(
+                "UPDATE slots SET reserved = reserved + ? WHERE outlet = ? AND date = ? AND slot = ? AND reserved + ? <= capacity",
+                (seats, outlet, date, slot, seats)
+            ).rowcount == 1
+    
+    def release(self, outlet, date, slot, seats):
+        with self._db() as db:
+            db.execute(
+                "UPDATE slots SET reserved = MAX(reserved - ?, 0) WHERE outlet = ? AND date = ? AND slot = ?",
+                (seats, outlet, date, slot)
+            )
+
+# SLOT_CAPACITY seats per lunch or dinner sitting, with per-outlet overrides
+# as JSON in SLOT_CAPACITIES, e.g. {"JP Nagar": 120}
+slot_store = SlotStore(
+    os.getenv("SLOT_DB", "slots.db"),
+    capacity=int(os.getenv("SLOT_CAPACITY", "80")),
+    capacities=json.loads(os.getenv("SLOT_CAPACITIES", "{}"))
+)
+
+# Throwaway stores and logger for replaying recorded transcripts: replayed
+# bookings take no real seats and their events never reach the log sink
+class ReplaySandbox:
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="replay-")
+        self.booking_store = BookingStore(os.path.join(self.directory, "bookings"))
+        self.slot_store = SlotStore(os.path.join(self.directory, "slots.db"), slot_store.capacity, slot_store.capacities)
+        self.logger = self  # log() below stands in for the event logger
+        self.sink = MemorySink()
+    
+    def log(self, data):
+        self.sink.write_rows([log_row(data)])
+        return True
+    
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+# The sandbox of the replay running in this thread, if any
+replay_sandbox = contextvars.ContextVar("replay_sandbox", default=None)
+
+def active(name):
+    # booking_store, slot_store or logger: the live one, or the sandbox's
+    # while a replay is stepping
+    sandbox = replay_sandbox.get()
+    return getattr(sandbox, name) if sandbox is not None else globals()[name]
+
+# Per-state input handlers, referenced from the StateMachine definition. Each
+# takes the conversation context and the user's input and updates the context
+def store(key):
+    def update(context, user_input):
+        context[key] = user_input
+    return update
+
+def choose(key, options):
+    # Stores the option picked by number; other input leaves context alone
+    def update(context, user_input):
+        if user_input in options:
+            context[key] = options[user_input]
+    return update
+
+def choose_numbered(key, options):
+    # Like choose(), for a numbered list; any spelling of the number counts
+    def update(context, user_input):
+        if user_input.isdigit() and 1 <= int(user_input) <= len(options):
+            context[key] = options[int(user_input) - 1]
+    return update
+
+def forget(*keys):
+    # Drops values carried over from an earlier part of the conversation
+    def update(context, user_input):
+        for key in keys:
+            context.pop(key, None)
+    return update
+
+def booking_slot(booking):
+    # The (outlet, date, slot) a booking or context takes seats from
+    time_slot = booking.get('time_slot') or ""
+    return booking.get('location', ""), booking.get('date', ""), time_slot.split(" ")[0]
+
+def guest_count(booking):
+    guests = booking.get('guests') or "0"
+    return int(guests) if guests.isdigit() else 0
+
+def seats_available(context):
+    # Seats left in the chosen slot, counting those the booking being changed
+    # already holds there
+    slot = booking_slot(context)
+    seats = active("slot_store").remaining(*slot)
+    booking = active("booking_store").get(context['reference']) if context.get('reference') else None
+    if booking is not None and booking['status'] == "confirmed" and booking_slot(booking) == slot:
+        seats += guest_count(booking)
+    return seats
+
+def store_date(context, user_input):
+    # Also shows how many seats each sitting has left that day
+    context['date'] = user_input
+    location = context.get('location', "")
+    context['seats'] = {slot: active("slot_store").remaining(location, user_input, slot) for slot in ("Lunch", "Dinner")}
+
+def check_guests(context, user_input):
+    # Sends the caller back for a smaller party if the slot can't seat them;
+    # otherwise the usual validation and transitions apply
+    if user_input.isdigit() and 1 <= int(user_input) <= 20:
+        seats = seats_available(context)
+        if int(user_input) > seats:
+            context['seats_error'] = seats
+            return "collect_guests"
+    context.pop('seats_error', None)
+    return None
+
+def confirm_booking(context, user_input):
+    # Takes the seats and saves the reservation on confirmation: a new
+    # booking, or the changes to the one looked up in verify_reference. If
+    # the slot filled up in the meantime the caller picks a smaller party
+    # or another time
+    if user_input != "1":
+        return None
+    bookings, slots = active("booking_store"), active("slot_store")
+    slot = booking_slot(context)
+    guests = guest_count(context)
+    booking = bookings.get(context['reference']) if context.get('reference') else None
+    if booking is not None and booking['status'] != "confirmed":
+        booking = None
+    if booking is not None and booking_slot(booking) == slot:
+        reserved = slots.reserve(*slot, guests - guest_count(booking))
+    else:
+        reserved = slots.reserve(*slot, guests)
+        if reserved and booking is not None:
+            slots.release(*booking_slot(booking), guest_count(booking))
+    if not reserved:
+        context['seats_error'] = seats_available(context)
+        return "collect_guests"
+    
+    if booking is not None:
+        booking = bookings.modify(booking['reference'], context)
+    context['modified'] = booking is not None
+    if booking is None:
+        booking = bookings.create(context)
+    context['reference'] = booking['reference']
+    return "booking_complete"
+
+def find_booking(context, user_input):
+    # Looks up a reservation by its reference code and loads it into the
+    # context. Only the code will do: a phone number is too easy to know for
+    # it to open someone else's booking
+    context.pop('reference_error', None)
+    if user_input.lower() == "back":
+        return None
+    booking = active("booking_store").get(user_input.strip().upper())
+    if booking is None or booking['status'] != "confirmed":
+        context['reference_error'] = user_input
+        return "verify_reference"
+    context.update((field, booking[field]) for field in BookingStore.FIELDS)
+    context['reference'] = booking['reference']
+    return "modification_options"
+
+def cancel_reservation(context, user_input):
+    if user_input == "1" and context.get('reference'):
+        booking = active("booking_store").cancel(context['reference'])
+        if booking is not None:
+            active("slot_store").release(*booking_slot(booking), guest_count(booking))
+
+def kb_scope(context):
+    # Callers who picked a city (and outlet) only get answers for it and
+    # the global ones; KB_SCOPED=0 always searches everything
+    if not kb_scoped or not context.get('city'):
+        return None
+    return context['city'], context.get('location', "")
+
+def answer_question(context, user_input):
+    # Every knowledge_query turn goes to the knowledge base and on to the answer
+    context['kb_response'] = (query_batcher or kb).query(user_input, scope=kb_scope(context))
+    return "knowledge_response"
+
+# Events logged when the user leaves a terminal state. The outcome is a
+# string, or like the summary a function of the context
+def log_event(outcome, summary):
+    def event(context):
+        return {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "phone": context.get('phone', ''),
+            "outcome": outcome(context) if callable(outcome) else outcome,
+            "summary": summary(context)
+        }
+    return event
 
 # State machine definitions
 class StateMachine:
@@ -437,7 +1873,8 @@ class StateMachine:
                     "1": "collect_location_bangalore",
                     "2": "collect_location_delhi",
                     "back": "start"
-                }
+                },
+                "input": choose('city', {"1": "Bangalore", "2": "Delhi"})
             },
             "collect_location_bangalore": {
                 "template": "location_bangalore.jinja",
@@ -447,7 +1884,8 @@ class StateMachine:
                     "3": "main_options",  # Electronic City
                     "4": "main_options",  # Koramangala
                     "back": "collect_city"
-                }
+                },
+                "input": choose_numbered('location', ["Indiranagar", "JP Nagar", "Electronic City", "Koramangala"])
             },
             "collect_location_delhi": {
                 "template": "location_delhi.jinja",
@@ -456,7 +1894,8 @@ class StateMachine:
                     "2": "main_options",  # Vasant Kunj
                     "3": "main_options",  # Janakpuri
                     "back": "collect_city"
-                }
+                },
+                "input": choose_numbered('location', ["Connaught Place", "Vasant Kunj", "Janakpuri"])
             },
             "main_options": {
                 "template": "main_options.jinja",
@@ -473,7 +1912,8 @@ class StateMachine:
                 "transitions": {
                     "next": "collect_date",
                     "back": "main_options"
-                }
+                },
+                "input": forget('reference', 'modified')  # A new booking, not a change to a looked-up one
             },
             "collect_date": {
                 "template": "collect_date.jinja",
@@ -481,7 +1921,8 @@ class StateMachine:
                     "next": "collect_time",
                     "back": "new_booking"
                 },
-                "validation": lambda x: bool(re.match(r"^\d{2}-\d{2}-\d{4}$", x))
+                "validation": re.compile(r"^\d{2}-\d{2}-\d{4}$").match,
+                "input": store_date
             },
             "collect_time": {
                 "template": "collect_time.jinja",
@@ -489,7 +1930,8 @@ class StateMachine:
                     "1": "collect_guests",  # Lunch
                     "2": "collect_guests",  # Dinner
                     "back": "collect_date"
-                }
+                },
+                "input": choose('time_slot', {"1": "Lunch (12:00 PM - 4:00 PM)", "2": "Dinner (6:30 PM - 11:00 PM)"})
             },
             "collect_guests": {
                 "template": "collect_guests.jinja",
@@ -497,7 +1939,9 @@ class StateMachine:
                     "next": "collect_phone",
                     "back": "collect_time"
                 },
-                "validation": lambda x: x.isdigit() and 1 <= int(x) <= 20
+                "validation": lambda x: x.isdigit() and 1 <= int(x) <= 20,
+                "input": store('guests'),
+                "handler": check_guests  # Falls through to the validation when the party fits
             },
             "collect_phone": {
                 "template": "collect_phone.jinja",
@@ -505,7 +1949,8 @@ class StateMachine:
                     "next": "booking_confirmation",
                     "back": "collect_guests"
                 },
-                "validation": lambda x: bool(re.match(r"^\d{10}$", x))
+                "validation": re.compile(r"^\d{10}$").match,
+                "input": store('phone')
             },
             "booking_confirmation": {
                 "template": "booking_confirmation.jinja",
@@ -513,14 +1958,19 @@ class StateMachine:
                     "1": "booking_complete",  # Confirm
                     "2": "new_booking",      # Start over
                     "back": "collect_phone"
-                }
+                },
+                "handler": confirm_booking
             },
             "booking_complete": {
                 "template": "booking_complete.jinja",
                 "transitions": {
                     "1": "start",  # Back to start
                     "2": "end"     # End conversation
-                }
+                },
+                "log": log_event(
+                    lambda context: "modification" if context.get('modified') else "new_booking",
+                    lambda context: f"{'Changed' if context.get('modified') else 'New'} booking at {context.get('location', '')} for {context.get('guests', '')} guests on {context.get('date', '')}"
+                )
             },
             "modify_booking": {
                 "template": "modify_booking.jinja",
@@ -535,7 +1985,7 @@ class StateMachine:
                     "next": "modification_options",
                     "back": "modify_booking"
                 },
-                "validation": lambda x: bool(re.match(r"^[A-Z0-9]{6}$", x))
+                "handler": find_booking
             },
             "modification_options": {
                 "template": "modification_options.jinja",
@@ -553,21 +2003,25 @@ class StateMachine:
                     "1": "cancellation_complete",  # Confirm cancellation
                     "2": "modification_options",   # Back to modification options
                     "back": "modification_options"
-                }
+                },
+                "input": cancel_reservation
             },
             "cancellation_complete": {
                 "template": "cancellation_complete.jinja",
                 "transitions": {
                     "1": "start",  # Back to start
                     "2": "end"     # End conversation
-                }
+                },
+                "log": log_event("cancellation", lambda context: f"Cancelled booking {context.get('reference', '')}")
             },
             "knowledge_query": {
                 "template": "knowledge_query.jinja",
                 "transitions": {
                     "next": "knowledge_response",
                     "back": "main_options"
-                }
+                },
+                "handler": answer_question,  # Replaces the transitions: every input is a question
+                "blocking": True  # Runs the transformer (see kb_executor)
             },
             "knowledge_response": {
                 "template": "knowledge_response.jinja",
@@ -590,21 +2044,24 @@ class StateMachine:
                     "next": "collect_comments",
                     "back": "feedback"
                 },
-                "validation": lambda x: x.isdigit() and 1 <= int(x) <= 5
+                "validation": lambda x: x.isdigit() and 1 <= int(x) <= 5,
+                "input": store('rating')
             },
             "collect_comments": {
                 "template": "collect_comments.jinja",
                 "transitions": {
                     "next": "feedback_complete",
                     "back": "collect_ratings"
-                }
+                },
+                "input": store('comments')
             },
             "feedback_complete": {
                 "template": "feedback_complete.jinja",
                 "transitions": {
                     "1": "start",  # Back to start
                     "2": "end"     # End conversation
-                }
+                },
+                "log": log_event("feedback", lambda context: f"Rating: {context.get('rating', '')}/5")
             },
             "end": {
                 "template": "end.jinja",
@@ -612,123 +2069,406 @@ class StateMachine:
             }
         }
         
+        self.blocking = {name for name, state in self.states.items() if state.get("blocking")}
+        
+        # Flatten each state into a tuple once, so a turn costs one dictionary
+        # lookup plus that state's own handlers however many states there are
+        self.dispatch = {
+            name: (
+                state["transitions"],
+                state["transitions"].get("next"),
+                state.get("validation"),
+                state.get("handler"),
+                state.get("input"),
+                state.get("log")
+            )
+            for name, state in self.states.items()
+        }
+        
     def get_template(self, state):
         return self.states[state]["template"]
     
     def get_next_state(self, current_state, input_value):
-        if current_state not in self.states:
+        if current_state not in self.dispatch:
             return "start"  # Default to start if invalid state
-        
-        transitions = self.states[current_state]["transitions"]
-        
+        transitions, fallback, validator = self.dispatch[current_state][:3]
+        return self._transition(current_state, input_value, transitions, fallback, validator)
+    
+    def _transition(self, current_state, input_value, transitions, fallback, validator):
         # Check if input requires validation
-        if "validation" in self.states[current_state]:
-            validator = self.states[current_state]["validation"]
-            if not validator(input_value):
-                return current_state  # Stay in current state if validation fails
+        if validator is not None and not validator(input_value):
+            return current_state  # Stay in current state if validation fails
         
         # Process transition
         if input_value in transitions:
             return transitions[input_value]
-        elif "next" in transitions and input_value.lower() != "back":
-            return transitions["next"]
+        elif fallback is not None and input_value.lower() != "back":
+            return fallback
         else:
             return current_state  # Stay in current state if no valid transition
+    
+    def step(self, current_state, input_value, context):
+        # Advance one turn: pick the next state, apply the state's context
+        # update and log its event if it has one
+        entry = self.dispatch.get(current_state)
+        if entry is None:
+            return "start"  # Default to start if invalid state
+        transitions, fallback, validator, handler, update, event = entry
+        
+        start = time.perf_counter()
+        next_state = None
+        if handler is not None:
+            # A handler picks the next state itself, or returns None to leave
+            # it to the transitions
+            next_state = handler(context, input_value)
+            start = metrics.since("handler", start, current_state)
+        if next_state is None:
+            next_state = self._transition(current_state, input_value, transitions, fallback, validator)
+            start = metrics.since("transition", start, current_state)
+        if update is not None:
+            update(context, input_value)
+        if event is not None:
+            start = time.perf_counter()
+            active("logger").log(event(context))
+            metrics.since("log", start, current_state)
+        return next_state
 
 # Initialize state machine
 state_machine = StateMachine()
 
+# Server-side conversation sessions. With a store configured, a client that
+# sends no context gets a session id back and from then on sends only the
+# message and that id; state and context stay on the server
+class MemorySessionStore:
+    def __init__(self, maxsize=10000, ttl=1800):
+        self.sessions = LRUCache(maxsize, ttl)
+    
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+    
+    def put(self, session_id, state, context):
+        self.sessions.put(session_id, (state, context))
+
+# Sessions in a local SQLite file, shared by every worker on the box. Sessions
+# idle for longer than ttl count as gone and are purged now and then
+class SQLiteSessionStore:
+    def __init__(self, path="sessions.db", ttl=1800):
+        self.path = path
+        self.ttl = ttl
+        self._db = SQLiteConnections(path).connect
+        with self._db() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT, context TEXT, updated REAL)")
+    
+    def get(self, session_id):
+        row = self._db().execute(
+            "SELECT state, context FROM sessions WHERE id = ? AND updated > ?",
+            (session_id, time.time() - self.ttl)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+    
+    def put(self, session_id, state, context):
+        with self._db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                (session_id, state, json.dumps(context), time.time())
+            )
+            if random.random() < 0.01:
+                db.execute("DELETE FROM sessions WHERE updated <= ?", (time.time() - self.ttl,))
+
+# SESSION_STORE=memory or sqlite turns sessions on; off by default so the
+# Retell contract of sending state and context back stays as it was. Memory
+# sessions live in one process, so they only work with a single worker
+# (gunicorn.conf.py refuses them when WEB_CONCURRENCY > 1); use sqlite
+# whenever several workers share the socket
+session_store = None
+if os.getenv("SESSION_STORE") == "memory":
+    session_store = MemorySessionStore(int(os.getenv("SESSION_MAX", "10000")), float(os.getenv("SESSION_TTL", "1800")))
+elif os.getenv("SESSION_STORE") == "sqlite":
+    session_store = SQLiteSessionStore(os.getenv("SESSION_DB", "sessions.db"), float(os.getenv("SESSION_TTL", "1800")))
+
 # Jinja2 template environment
-from jinja2 import Environment, FileSystemLoader
-template_env = Environment(loader=FileSystemLoader('templates'))
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, nodes
+
+# Templates only change on deploy, so in production skip the filesystem check
+# on every lookup, and share compiled bytecode between workers and restarts
+# through JINJA_BYTECODE_CACHE. In development (FLASK_DEBUG=1, or app.py run
+# directly) edits show up at once; JINJA_AUTO_RELOAD=0 or 1 overrides either
+bytecode_dir = os.getenv("JINJA_BYTECODE_CACHE", ".jinja_cache")
+if bytecode_dir:
+    os.makedirs(bytecode_dir, exist_ok=True)
+template_env = Environment(
+    loader=FileSystemLoader('templates'),
+    auto_reload=os.getenv("JINJA_AUTO_RELOAD", os.getenv("FLASK_DEBUG", "0")) == "1",
+    bytecode_cache=FileSystemBytecodeCache(bytecode_dir) if bytecode_dir else None
+)
+
+def context_paths(ast):
+    # The context lookups a template makes, as key paths such as
+    # ('kb_response', 'answer'), or None if it uses the context in a way its
+    # output can't be keyed on (passing it around whole, dynamic keys, or
+    # names that would resolve to dict methods)
+    paths = set()
+    
+    def chain(node):
+        if isinstance(node, nodes.Name):
+            return () if node.name == "context" else None
+        if isinstance(node, nodes.Getattr):
+            key = node.attr
+        elif isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+            key = node.arg.value
+        else:
+            return None
+        base = chain(node.node)
+        return None if base is None else base + (key,)
+    
+    def walk(node):
+        path = chain(node)
+        if path is not None:
+            paths.add(path)
+            return
+        for child in node.iter_child_nodes():
+            walk(child)
+    
+    walk(ast)
+    if () in paths or any(hasattr(dict, key) for path in paths for key in path):
+        return None
+    return tuple(sorted(paths))
+
+def context_value(context, path):
+    # What a template sees at path: how deep the lookup got, and the value
+    # there (repr'd if unhashable). Including the depth keeps a missing key
+    # distinct from a value that is present. A key missing from a dict is
+    # undefined whatever else the dict holds, so the dict itself is left out
+    # of the key: otherwise every distinct context (phone numbers and all)
+    # would get its own cache entry
+    value = context
+    for depth, key in enumerate(path):
+        if not isinstance(value, dict):
+            break
+        if key not in value:
+            return depth, None
+        value = value[key]
+    else:
+        depth = len(path)
+    try:
+        hash(value)
+    except TypeError:
+        value = repr(value)
+    return depth, value
+
+# Renders state templates, memoising each one's output on only the context
+# values it reads. Every template is compiled at startup, so no turn pays the
+# compile cost or a filesystem check; static menus are rendered once up front
+# and templates that read the context are cached per distinct combination of
+# those values. With auto-reload on (development) templates are looked up
+# and rendered on every turn instead
+class ResponseRenderer:
+    def __init__(self, env, template_names, cache_size=4096):
+        self.env = env
+        self.templates = {}
+        self.paths = {}
+        self.caches = {}
+        for name in template_names:
+            self.templates[name] = env.get_template(name)
+            source = env.loader.get_source(env, name)[0]
+            self.paths[name] = context_paths(env.parse(source))
+            if self.paths[name] is not None:
+                self.caches[name] = LRUCache(cache_size)
+                if not self.paths[name]:
+                    self.caches[name].put((), self.templates[name].render(context={}))
+    
+    def render(self, name, context):
+        paths = self.paths.get(name)
+        if paths is None or self.env.auto_reload:
+            return self.env.get_template(name).render(context=context)
+        key = tuple(context_value(context, path) for path in paths)
+        response = self.caches[name].get(key)
+        if response is None:
+            response = self.templates[name].render(context=context)
+            self.caches[name].put(key, response)
+        return response
+
+renderer = ResponseRenderer(
+    template_env,
+    template_env.list_templates(extensions=["jinja"]),
+    int(os.getenv("TEMPLATE_CACHE_SIZE", "4096"))
+)
+
+# Cache hit rates, read from the caches themselves when /metrics is scraped
+def cache_metrics():
+    caches = {"kb_answers": [kb.answer_cache], "kb_embeddings": [kb.embedding_cache], "templates": list(renderer.caches.values())}
+    if isinstance(session_store, MemorySessionStore):
+        caches["sessions"] = [session_store.sessions]
+    for cache, lrus in caches.items():
+        stats = [lru.stats() for lru in lrus]
+        for stat in ("hits", "misses", "size"):
+            yield f"cache_{stat}", [("cache", cache)], sum(s[stat] for s in stats)
+
+metrics.collectors.append(cache_metrics)
 
 # Routes
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.json
+# What keeps menu turns moving while a caller waits on the model is Gunicorn's
+# gthread workers: a knowledge turn holds its own request thread for the whole
+# forward pass (or batch), and the worker's other threads keep serving.
+# Nothing here frees that thread. Without micro-batching, the pool below only
+# caps how many forward passes compete for the CPU at once (KB_WORKERS, torch
+# releases the GIL while encoding); with it, the batcher thread is already
+# the only one running the model, so there is no pool
+kb_executor = None
+if query_batcher is None:
+    kb_executor = ThreadPoolExecutor(max_workers=int(os.getenv("KB_WORKERS", "2")), thread_name_prefix="kb")
+
+def load_turn(data):
+    # The user's input, session id (None without sessions), state, context
+    # and whether the caller's session had expired
     user_input = data.get('message', '')
-    current_state = data.get('state', 'start')
-    context = data.get('context', {})
-    
-    # Process knowledge query if in knowledge_query state
-    if current_state == "knowledge_query":
-        kb_response = kb.query(user_input)
-        context['kb_response'] = kb_response
-        next_state = "knowledge_response"
+    session_id = None
+    expired = False
+    if session_store is not None and 'context' not in data:
+        session_id = data.get('session_id')
+        session = session_store.get(session_id) if session_id else None
+        if session is None:
+            # A first message starts a new conversation. An unknown or expired
+            # session id gets a fresh session too, but its message answered
+            # some earlier prompt, so it isn't read as a reply to the menu
+            expired = session_id is not None
+            session_id = secrets.token_urlsafe(16)
+            session = ('start', {})
+        current_state, context = session
     else:
-        # Normal state transition
-        next_state = state_machine.get_next_state(current_state, user_input)
-    
-    # Update context based on user input and current state
-    if current_state == "collect_city" and user_input == "1":
-        context['city'] = "Bangalore"
-    elif current_state == "collect_city" and user_input == "2":
-        context['city'] = "Delhi"
-    elif current_state == "collect_location_bangalore":
-        locations = ["Indiranagar", "JP Nagar", "Electronic City", "Koramangala"]
-        if user_input.isdigit() and 1 <= int(user_input) <= 4:
-            context['location'] = locations[int(user_input) - 1]
-    elif current_state == "collect_location_delhi":
-        locations = ["Connaught Place", "Vasant Kunj", "Janakpuri"]
-        if user_input.isdigit() and 1 <= int(user_input) <= 3:
-            context['location'] = locations[int(user_input) - 1]
-    elif current_state == "collect_date":
-        context['date'] = user_input
-    elif current_state == "collect_time":
-        if user_input == "1":
-            context['time_slot'] = "Lunch (12:00 PM - 4:00 PM)"
-        elif user_input == "2":
-            context['time_slot'] = "Dinner (6:30 PM - 11:00 PM)"
-    elif current_state == "collect_guests":
-        context['guests'] = user_input
-    elif current_state == "collect_phone":
-        context['phone'] = user_input
-    elif current_state == "verify_reference":
-        context['reference'] = user_input
-    elif current_state == "collect_ratings":
-        context['rating'] = user_input
-    elif current_state == "collect_comments":
-        context['comments'] = user_input
-    
-    # Log completed actions
-    if current_state == "booking_complete":
-        logger.log({
-            "timestamp": datetime.datetime.now().isoformat(),
-            "phone": context.get('phone', ''),
-            "outcome": "new_booking",
-            "summary": f"New booking at {context.get('location', '')} for {context.get('guests', '')} guests on {context.get('date', '')}"
-        })
-    elif current_state == "cancellation_complete":
-        logger.log({
-            "timestamp": datetime.datetime.now().isoformat(),
-            "phone": context.get('phone', ''),
-            "outcome": "cancellation",
-            "summary": f"Cancelled booking {context.get('reference', '')}"
-        })
-    elif current_state == "feedback_complete":
-        logger.log({
-            "timestamp": datetime.datetime.now().isoformat(),
-            "phone": context.get('phone', ''),
-            "outcome": "feedback",
-            "summary": f"Rating: {context.get('rating', '')}/5"
-        })
-    
+        current_state = data.get('state', 'start')
+        context = data.get('context', {})
+    return user_input, session_id, current_state, context, expired
+
+def finish_turn(session_id, next_state, context, expired=False):
     # Generate response using Jinja template
-    template = template_env.get_template(state_machine.get_template(next_state))
-    response_text = template.render(context=context)
+    start = time.perf_counter()
+    response_text = renderer.render(
+        state_machine.get_template(next_state),
+        dict(context, session_expired=True) if expired else context
+    )
+    metrics.since("render", start, next_state)
     
     # Generate Retell response
-    retell_response = {
+    if session_id is not None:
+        session_store.put(session_id, next_state, context)
+        response = {
+            "response": response_text,
+            "state": next_state,
+            "session_id": session_id
+        }
+        if expired:
+            response["session_expired"] = True
+            metrics.inc("sessions_expired")
+        return response
+    return {
         "response": response_text,
         "state": next_state,
         "context": context
     }
-    
-    return jsonify(retell_response)
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    user_input, session_id, current_state, context, expired = load_turn(request.json)
+    if expired:
+        return jsonify(finish_turn(session_id, current_state, context, expired=True))
+    if kb_executor is not None and current_state in state_machine.blocking:
+        next_state = kb_executor.submit(state_machine.step, current_state, user_input, context).result()
+    else:
+        next_state = state_machine.step(current_state, user_input, context)
+    return jsonify(finish_turn(session_id, next_state, context))
+
+# Replays many conversations side by side, one turn of each per round, so the
+# free-text turns of a round reach the knowledge base as one batched encode.
+# Each conversation is a dict with optional 'state' and 'context' and a list
+# of 'messages'. Yields one result per turn, as soon as its round finishes.
+# Bookings, seats and logged events go to a ReplaySandbox (a fresh one unless
+# one is passed in), never to the live stores or the log sink
+def replay(conversations, sandbox=None):
+    running = [
+        (index, conversation.get('state', 'start'), dict(conversation.get('context') or {}), list(conversation.get('messages', [])))
+        for index, conversation in enumerate(conversations)
+    ]
+    own_sandbox = sandbox is None
+    if own_sandbox:
+        sandbox = ReplaySandbox()
+    try:
+        turn = 0
+        while running:
+            running = [entry for entry in running if turn < len(entry[3])]
+            
+            # Warm the answer cache for the whole round in one call; the steps
+            # below then answer from it instead of encoding one at a time
+            kb.answer_many([
+                (messages[turn], 0.6, kb_scope(context))
+                for _, state, context, messages in running if state in state_machine.blocking
+            ])
+            
+            advanced = []
+            for index, current_state, context, messages in running:
+                # Set around the step only: the caller runs between yields
+                token = replay_sandbox.set(sandbox)
+                try:
+                    next_state = state_machine.step(current_state, messages[turn], context)
+                finally:
+                    replay_sandbox.reset(token)
+                start = time.perf_counter()
+                response_text = renderer.render(state_machine.get_template(next_state), context)
+                metrics.since("render", start, next_state)
+                yield {
+                    "conversation": index,
+                    "turn": turn,
+                    "response": response_text,
+                    "state": next_state,
+                    "context": dict(context)
+                }
+                advanced.append((index, next_state, context, messages))
+            running = advanced
+            turn += 1
+    finally:
+        if own_sandbox:
+            sandbox.close()
+
+def admin_authorized():
+    # Admin endpoints need "Authorization: Bearer <ADMIN_TOKEN>" and are off
+    # without a token
+    token = os.getenv("ADMIN_TOKEN")
+    return bool(token) and secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+# Reloads the knowledge base files now instead of at the watcher's next
+# check. Admin only
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(kb.reload())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Batch form of /chat for replaying recorded transcripts. Takes
+# {"conversations": [...]} in replay()'s format and/or {"turns": [...]} of
+# independent /chat-style turns (state, context, message), and streams one
+# JSON line per turn. Single turns are numbered after the conversations.
+# Admin only, like /admin/reload
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    data = request.json
+    conversations = list(data.get('conversations', []))
+    conversations += [
+        {"state": turn.get('state', 'start'), "context": turn.get('context', {}), "messages": [turn.get('message', '')]}
+        for turn in data.get('turns', [])
+    ]
+    return Response((json.dumps(result) + "\n" for result in replay(conversations)), mimetype="application/x-ndjson")
 
 if __name__ == '__main__':
+    # The debug reloader only watches Python files, so templates need theirs
+    template_env.auto_reload = os.getenv("JINJA_AUTO_RELOAD", "1") == "1"
     app.run(debug=True)
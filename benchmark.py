@@ -0,0 +1,412 @@
+# Offline benchmarks: python benchmark.py ann|quantize|kb|state|render|load|all
+# Add --output results.json to keep the results for comparing commits
+import argparse
+import datetime
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Don't load the model on import, log to memory instead of Google Sheets and
+# keep the spool and embedding cache out of the working tree
+os.environ.setdefault("KB_LOAD_MODE", "lazy")
+os.environ.setdefault("LOG_SINK", "memory")
+os.environ.setdefault("LOG_SPOOL_DIR", tempfile.mkdtemp(prefix="bench-spool-"))
+os.environ.setdefault("KB_EMBEDDING_CACHE", "")
+os.environ.setdefault("BOOKING_STORE_DIR", tempfile.mkdtemp(prefix="bench-bookings-"))
+os.environ.setdefault("SLOT_DB", os.path.join(os.environ["BOOKING_STORE_DIR"], "slots.db"))
+os.environ.setdefault("SLOT_CAPACITY", "1000000")  # Scripted bookings all want the same sitting
+import app
+from app import IVFIndex, KnowledgeBase, normalize, quantize
+
+# Stand-in for the sentence transformer so the benchmarks run offline and
+# give the same numbers on every machine: hashed word and word-pair features.
+# It measures everything around the model; use --encoder model for the real
+# one (downloaded on first use)
+class HashingEncoder:
+    def __init__(self, dim=384):
+        self.dim = dim
+    
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+    
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"[a-z0-9]+", text.lower())
+            for feature in words + [a + " " + b for a, b in zip(words, words[1:])]:
+                h = zlib.crc32(feature.encode("utf-8"))
+                embeddings[row, h % self.dim] += 1.0 if h & 1 << 31 else -1.0
+        return embeddings
+
+def make_encoder(name):
+    if name == "model":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer("all-MiniLM-L6-v2")
+    return HashingEncoder()
+
+def percentiles(samples):
+    # Latency summary in milliseconds
+    samples = np.asarray(samples) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(samples, 50)), 4),
+        "p95_ms": round(float(np.percentile(samples, 95)), 4),
+        "p99_ms": round(float(np.percentile(samples, 99)), 4),
+        "mean_ms": round(float(samples.mean()), 4)
+    }
+
+def synthetic_corpus(size, dim=384, topics=None, spread=0.6, seed=0):
+    # Clustered unit vectors standing in for sentence embeddings: FAQ
+    # questions bunch around topics rather than spreading out uniformly
+    rng = np.random.default_rng(seed)
+    topics = topics or max(8, size // 50)
+    centres = normalize(rng.standard_normal((topics, dim)))
+    corpus = centres[rng.integers(topics, size=size)] + spread * rng.standard_normal((size, dim)) / np.sqrt(dim)
+    return normalize(corpus)
+
+def synthetic_questions(corpus, count, noise=0.3, seed=1):
+    # Paraphrase-like questions: perturbed copies of stored queries
+    rng = np.random.default_rng(seed)
+    picks = corpus[rng.integers(len(corpus), size=count)]
+    return normalize(picks + noise * rng.standard_normal(picks.shape) / np.sqrt(corpus.shape[1]))
+
+def exact_top_k(corpus, questions, k):
+    scores = questions @ corpus.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+def bench_ann(args):
+    # Recall of the IVF index against exact search, and per-query latency of
+    # both, for each corpus size and nprobe
+    results = []
+    for size in args.sizes:
+        corpus = synthetic_corpus(size)
+        questions = synthetic_questions(corpus, args.queries)
+        truth = exact_top_k(corpus, questions, args.k)
+        
+        start = time.perf_counter()
+        for question in questions:
+            scores = corpus @ question
+            np.argpartition(-scores, args.k - 1)[:args.k]
+        exact_ms = (time.perf_counter() - start) * 1000 / len(questions)
+        
+        start = time.perf_counter()
+        index = IVFIndex(corpus)
+        build_s = time.perf_counter() - start
+        
+        for nprobe in args.nprobe:
+            index.nprobe = min(nprobe, index.nlist)
+            found, elapsed = [], 0.0
+            for question in questions:
+                start = time.perf_counter()
+                ids = index.candidates(question)[0]
+                scores = corpus[ids] @ question
+                top = min(args.k, len(ids))
+                found.append(set(ids[np.argpartition(-scores, top - 1)[:top]]))
+                elapsed += time.perf_counter() - start
+            recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+            result = {
+                "size": size, "nlist": index.nlist, "nprobe": index.nprobe,
+                "recall": round(float(recall), 4),
+                "exact_ms": round(exact_ms, 4),
+                "ivf_ms": round(elapsed * 1000 / len(questions), 4),
+                "build_s": round(build_s, 2)
+            }
+            results.append(result)
+            print(f"size={size:>7} nlist={index.nlist:>4} nprobe={index.nprobe:>3} "
+                  f"recall@{args.k}={result['recall']:.3f} exact={result['exact_ms']:.3f}ms "
+                  f"ivf={result['ivf_ms']:.3f}ms build={result['build_s']:.1f}s")
+    return results
+
+def bench_quantize(args):
+    # Matrix size, scoring latency and top-1 agreement with float32 for each
+    # storage type the knowledge base supports
+    results = []
+    for size in args.sizes:
+        corpus = synthetic_corpus(size)
+        questions = synthetic_questions(corpus, args.queries)
+        reference = np.argmax(questions @ corpus.T, axis=1)
+        for dtype in ("float32", "float16", "int8"):
+            matrix, scales = quantize(corpus, dtype)
+            start = time.perf_counter()
+            best = []
+            for question in questions:
+                scores = matrix.astype(np.float32) @ question if dtype != "float32" else matrix @ question
+                if scales is not None:
+                    scores *= scales
+                best.append(np.argmax(scores))
+            result = {
+                "size": size, "dtype": dtype,
+                "megabytes": round((matrix.nbytes + (scales.nbytes if scales is not None else 0)) / 2**20, 2),
+                "query_ms": round((time.perf_counter() - start) * 1000 / len(questions), 4),
+                "top1_agreement": round(float(np.mean(np.array(best) == reference)), 4)
+            }
+            results.append(result)
+            print(f"size={size:>7} dtype={dtype:<8} memory={result['megabytes']:>8.2f}MB "
+                  f"query={result['query_ms']:.3f}ms top1={result['top1_agreement']:.3f}")
+    return results
+
+def synthetic_pairs(size, outlets=0, seed=0):
+    # The real pairs padded out with generated ones to reach a corpus size,
+    # spread over that many synthetic outlets if outlets is set
+    pairs = list(app.kb._load_qa_pairs())
+    words = sorted({word for pair in pairs for word in re.findall(r"[a-z]+", pair["query"].lower())})
+    rng = np.random.default_rng(seed)
+    while len(pairs) < size:
+        query = " ".join(rng.choice(words, size=rng.integers(5, 12)))
+        pair = {"query": query + "?", "answer": f"Answer to {query}.", "source": "synthetic"}
+        if outlets:
+            pair.update(city="Synthetic", location=f"Outlet {len(pairs) % outlets}")
+        pairs.append(pair)
+    return pairs[:size]
+
+def scope_of(pair):
+    # The (city, location) a caller asking this pair's question would be in;
+    # the first outlet for pairs shared by several
+    if not pair.get("city"):
+        return None
+    location = pair.get("location") or ""
+    return pair["city"], location if isinstance(location, str) else location[0]
+
+def paraphrase(question, rng):
+    # Drop a word so the question misses the answer cache but stays close
+    words = question.split()
+    if len(words) > 3:
+        del words[rng.integers(len(words))]
+    return " ".join(words)
+
+def bench_kb(args):
+    # KnowledgeBase.query latency on a cold answer cache, on a warm one, and
+    # answer_many throughput, for each corpus size. With --outlets each
+    # question is scoped to the outlet of the pair it paraphrases
+    results = []
+    encoder = make_encoder(args.encoder)
+    rng = np.random.default_rng(1)
+    for size in args.sizes:
+        pairs = synthetic_pairs(size, args.outlets)
+        kb = KnowledgeBase(model=encoder, qa_pairs=pairs)
+        start = time.perf_counter()
+        kb.load()
+        load_s = time.perf_counter() - start
+        picks = rng.integers(size, size=args.queries)
+        questions = [paraphrase(pairs[i]["query"], rng) for i in picks]
+        scopes = [scope_of(pairs[i]) if args.outlets else None for i in picks]
+        
+        kb.answer_cache.clear()
+        kb.embedding_cache.clear()
+        cold = []
+        for question, scope in zip(questions, scopes):
+            start = time.perf_counter()
+            kb.query(question, scope=scope)
+            cold.append(time.perf_counter() - start)
+        warm = []
+        for question, scope in zip(questions, scopes):
+            start = time.perf_counter()
+            kb.query(question, scope=scope)
+            warm.append(time.perf_counter() - start)
+        kb.answer_cache.clear()
+        kb.embedding_cache.clear()
+        start = time.perf_counter()
+        kb.answer_many([(question, 0.6, scope) for question, scope in zip(questions, scopes)])
+        batch_s = time.perf_counter() - start
+        
+        result = {
+            "size": size, "outlets": args.outlets, "encoder": args.encoder, "ann": kb.index.ann is not None,
+            "load_s": round(load_s, 3),
+            "cold": percentiles(cold), "cached": percentiles(warm),
+            "batch_qps": round(len(questions) / batch_s, 1)
+        }
+        results.append(result)
+        print(f"size={size:>7} load={load_s:.2f}s cold p50={result['cold']['p50_ms']:.3f}ms "
+              f"p99={result['cold']['p99_ms']:.3f}ms cached p50={result['cached']['p50_ms']:.4f}ms "
+              f"batch={result['batch_qps']:.0f} q/s")
+    return results
+
+def bench_state(args):
+    # StateMachine.get_next_state for every state with each of its
+    # transition keys, a free-text input and "back"
+    machine = app.state_machine
+    cases = [
+        (state, value)
+        for state, config in machine.states.items()
+        for value in list(config["transitions"]) + ["hello there", "back"]
+    ]
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        for state, value in cases:
+            machine.get_next_state(state, value)
+    elapsed = time.perf_counter() - start
+    calls = args.rounds * len(cases)
+    result = {"calls": calls, "ns_per_call": round(elapsed * 1e9 / calls, 1)}
+    print(f"get_next_state: {result['ns_per_call']:.0f}ns/call over {calls} calls")
+    return [result]
+
+def bench_render(args):
+    # Rendering each state's template with a realistic context, through the
+    # response cache when it repeats and with the template alone
+    context = {
+        "city": "Bangalore", "location": "Indiranagar", "date": "25-12-2026",
+        "time": "Lunch", "guests": "4", "phone": "9876543210",
+        "reference": "AB12CD", "rating": "5", "comments": "Great food",
+        "kb_response": {"answer": "We open at noon.", "source": "FAQ.pdf", "confidence": 0.8}
+    }
+    results = []
+    for state in app.state_machine.states:
+        name = app.state_machine.get_template(state)
+        template = app.renderer.templates[name]
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            template.render(context=context)
+        uncached = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            app.renderer.render(name, context)
+        cached = time.perf_counter() - start
+        result = {
+            "template": name,
+            "render_us": round(uncached * 1e6 / args.rounds, 2),
+            "cached_us": round(cached * 1e6 / args.rounds, 2)
+        }
+        results.append(result)
+        print(f"{name:<32} render={result['render_us']:>8.2f}us cached={result['cached_us']:>6.2f}us")
+    return results
+
+# Scripted conversations for the load generator: the inputs a caller types,
+# from the start state. {phone} is unique to each conversation, and
+# {reference} is the reference of the booking it made
+BOOKING = ["1", "1", "2", "1", "ok", "25-12-2026", "1", "4", "{phone}", "1"]
+CONVERSATIONS = {
+    "booking": BOOKING + ["2"],
+    "cancellation": BOOKING + ["1", "1", "1", "1", "2", "ok", "{reference}", "4", "1", "2"],
+    "feedback": ["4", "ok", "5", "Great food and service", "2"],
+    "faq": ["3", "What are the veg starters?", "1", "Do you have parking at Indiranagar?", "1",
+            "What time do you open for lunch?", "2"]
+}
+
+def bench_load(args):
+    # Drive the scripted conversations through /chat from --concurrency
+    # threads, each running a mix of conversation kinds, against the app in
+    # process or a running server (--url)
+    if args.url is None:
+        if args.encoder == "hashing" and app.kb.model is None:
+            app.kb.model = HashingEncoder()
+        app.kb.load()
+        client = app.app.test_client()
+        def post(payload):
+            return client.post("/chat", json=payload).get_json()
+    else:
+        def post(payload):
+            request = urllib.request.Request(
+                args.url.rstrip("/") + "/chat", data=json.dumps(payload).encode("utf-8"),
+                headers={"Content-Type": "application/json"}
+            )
+            with urllib.request.urlopen(request) as response:
+                return json.load(response)
+    
+    kinds = list(CONVERSATIONS)
+    latencies = {kind: [] for kind in kinds}
+    lock = threading.Lock()
+    
+    def converse(n):
+        kind = kinds[n % len(kinds)]
+        state, context, samples = "start", {}, []
+        for message in CONVERSATIONS[kind]:
+            message = message.format(phone=f"9{n:09d}", reference=context.get("reference", ""))
+            start = time.perf_counter()
+            reply = post({"message": message, "state": state, "context": context})
+            samples.append(time.perf_counter() - start)
+            state, context = reply["state"], reply.get("context", context)
+        with lock:
+            latencies[kind].extend(samples)
+    
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        start = time.perf_counter()
+        list(pool.map(converse, range(args.conversations)))
+        elapsed = time.perf_counter() - start
+    
+    every = [sample for samples in latencies.values() for sample in samples]
+    result = {
+        "concurrency": args.concurrency, "conversations": args.conversations,
+        "turns": len(every), "seconds": round(elapsed, 3),
+        "turns_per_s": round(len(every) / elapsed, 1),
+        "latency": percentiles(every),
+        "by_kind": {kind: percentiles(samples) for kind, samples in latencies.items() if samples}
+    }
+    print(f"concurrency={args.concurrency} turns={len(every)} {result['turns_per_s']:.0f} turns/s "
+          f"p50={result['latency']['p50_ms']:.2f}ms p95={result['latency']['p95_ms']:.2f}ms "
+          f"p99={result['latency']['p99_ms']:.2f}ms")
+    return [result]
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the chat pipeline")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ann = commands.add_parser("ann", help="IVF recall vs latency against exact search")
+    ann.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16])
+    ann.add_argument("--queries", type=int, default=200)
+    ann.add_argument("-k", type=int, default=5)
+    quant = commands.add_parser("quantize", help="float16/int8 storage vs float32")
+    quant.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    quant.add_argument("--queries", type=int, default=200)
+    kb = commands.add_parser("kb", help="KnowledgeBase.query latency by corpus size")
+    kb.add_argument("--sizes", type=int, nargs="+", default=[64, 1000, 10000])
+    kb.add_argument("--queries", type=int, default=200)
+    kb.add_argument("--outlets", type=int, default=0, help="spread the corpus over this many outlets and scope queries")
+    state = commands.add_parser("state", help="StateMachine.get_next_state")
+    state.add_argument("--rounds", type=int, default=10000)
+    render = commands.add_parser("render", help="template rendering per state")
+    render.add_argument("--rounds", type=int, default=2000)
+    load = commands.add_parser("load", help="scripted conversations through /chat")
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--conversations", type=int, default=200)
+    load.add_argument("--url", help="a running server instead of the app in process")
+    everything = commands.add_parser("all", help="kb, state, render and load with their defaults")
+    for command in (kb, load, everything):
+        command.add_argument("--encoder", choices=["hashing", "model"], default="hashing")
+    args = parser.parse_args()
+    
+    benchmarks = {
+        "ann": bench_ann, "quantize": bench_quantize, "kb": bench_kb,
+        "state": bench_state, "render": bench_render, "load": bench_load
+    }
+    if args.command == "all":
+        names = ["kb", "state", "render", "load"]
+        for name in names:
+            # Fill in each benchmark's defaults from its own parser
+            defaults = vars(commands.choices[name].parse_args([]))
+            for key, value in defaults.items():
+                if not hasattr(args, key):
+                    setattr(args, key, value)
+    else:
+        names = [args.command]
+    results = {}
+    for name in names:
+        results[name] = benchmarks[name](args)
+    
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "commit": commit(),
+                "timestamp": datetime.datetime.now().isoformat(),
+                "args": vars(args),
+                "results": results
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
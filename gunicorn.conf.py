@@ -0,0 +1,62 @@
+# Gunicorn settings: gunicorn app:app
+import gc
+import glob
+import os
+import sys
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+
+# In-memory sessions live in one worker, and the next message of the same
+# conversation usually lands on another one
+if os.getenv("SESSION_STORE") == "memory" and workers > 1:
+    raise RuntimeError("SESSION_STORE=memory needs WEB_CONCURRENCY=1; use SESSION_STORE=sqlite with several workers")
+
+# Threaded workers: a knowledge query waiting on the model ties up its own
+# request thread for the whole forward pass, but only that one; the worker's
+# other threads keep serving menu turns. Size GUNICORN_THREADS for the
+# knowledge turns expected at once plus headroom for the rest
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# Import app.py in the master before forking, so the sentence-transformer
+# model and the embedding matrix are loaded once and shared copy-on-write
+# by every worker instead of each worker holding its own copy
+preload_app = os.getenv("KB_SHARED_MODEL", "1") == "1"
+
+# A background loader thread started in the master would not survive the
+# fork, so a preloaded app loads the model eagerly; otherwise each worker
+# starts serving straight away and loads it in the background
+os.environ.setdefault("KB_LOAD_MODE", "eager" if preload_app else "background")
+
+# The preloading master would only re-encode edits to the knowledge files for
+# nobody; the workers it forks run the watchers (see KB_WATCH_INTERVAL)
+if preload_app:
+    os.environ.setdefault("KB_WATCH_WORKERS_ONLY", "1")
+
+# Workers add up each other's metrics through snapshot files in METRICS_DIR
+# (see Metrics in app.py); read by app.py, which is imported after this file
+os.environ.setdefault("METRICS_DIR", ".metrics")
+
+def on_starting(server):
+    # A new server starts from zero
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "metrics-*.json")):
+        os.remove(path)
+
+def when_ready(server):
+    # Move everything loaded so far into the permanent generation; otherwise
+    # the first collection in each worker writes to the object headers and
+    # un-shares the pages holding them
+    if preload_app:
+        gc.freeze()
+
+# Read by app.py too, for workers that load the model after the fork
+os.environ.setdefault("TORCH_THREADS_PER_WORKER", "1")
+
+def post_fork(server, worker):
+    # Workers split the cores between them, so keep torch from starting an
+    # intra-op thread per core in every worker. Only if the master already
+    # imported it: workers loading the model later shouldn't pay for torch
+    # before serving their first request
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(int(os.environ["TORCH_THREADS_PER_WORKER"]))
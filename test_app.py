@@ -0,0 +1,439 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    # Offline: no model and no Google credentials needed. app reads its
+    # settings on import, so set them all before the first import
+    tmp = tmp_path_factory.mktemp("app")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("KB_LOAD_MODE", "lazy")
+        mp.setenv("KB_WATCH_INTERVAL", "0")
+        mp.setenv("KB_EMBEDDING_CACHE", "")
+        mp.setenv("LOG_SINK", "memory")
+        mp.setenv("LOG_SPOOL_DIR", str(tmp / "spool"))
+        mp.setenv("BOOKING_STORE_DIR", str(tmp / "bookings"))
+        mp.setenv("SLOT_DB", str(tmp / "slots.db"))
+        mp.setenv("METRICS_DIR", str(tmp / "metrics"))
+        mp.chdir(os.path.dirname(os.path.abspath(__file__)))
+        import app
+        from benchmark import HashingEncoder
+        app.kb.model = HashingEncoder()
+        yield app
+
+def test_spooled_logs_reach_sink(app, tmp_path):
+    # The first batch fails; the rows must still arrive, in order
+    sink = app.MemorySink(failure_rate=1.0)
+    logger = app.EventLogger(sink, spool_dir=str(tmp_path / "spool"))
+    for phone in ["9000000001", "9000000002", "9000000003"]:
+        assert logger.log({"phone": phone, "outcome": "new_booking", "summary": "test"})
+    logger.close()
+    assert sink.rows == []
+
+    sink.failure_rate = 0.0
+    logger = app.EventLogger(sink, spool_dir=str(tmp_path / "spool"))
+    logger.close()
+    assert [row[1] for row in sink.rows] == ["9000000001", "9000000002", "9000000003"]
+
+def test_booking_store_survives_reopen_and_compaction(app, tmp_path):
+    directory = str(tmp_path / "bookings")
+    store = app.BookingStore(directory, compact_every=3)
+    other = app.BookingStore(directory, compact_every=3)  # e.g. another worker
+    details = {"phone": "9000000001", "city": "Bangalore", "location": "JP Nagar", "date": "01-01-2030", "guests": "4"}
+    first = store.create(details)
+    second = store.create(dict(details, date="02-01-2030"))
+    assert other.get(first["reference"])["location"] == "JP Nagar"
+    assert [b["reference"] for b in other.find_by_phone("9000000001")] == [first["reference"], second["reference"]]
+
+    # The third change compacts the log; the other store reloads from the snapshot
+    other.modify(first["reference"], {"guests": "6"})
+    store.cancel(second["reference"])
+    assert store.get(first["reference"])["guests"] == "6"
+    assert other.find_by_outlet("JP Nagar", "02-01-2030") == []
+    assert [b["reference"] for b in app.BookingStore(directory).find_by_phone("9000000001")] == [first["reference"]]
+
+def test_slot_store_never_overbooks(app, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    slots = app.SlotStore(str(tmp_path / "slots.db"), capacity=10)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: slots.reserve("JP Nagar", "01-01-2030", "Dinner", 3), range(8)))
+    assert results.count(True) == 3
+    assert slots.remaining("JP Nagar", "01-01-2030", "Dinner") == 1
+    slots.release("JP Nagar", "01-01-2030", "Dinner", 3)
+    assert slots.reserve("JP Nagar", "01-01-2030", "Dinner", 4)
+    assert slots.remaining("JP Nagar", "01-01-2030", "Lunch") == 10
+
+def test_changes_need_the_reference_and_are_logged_as_modifications(app, tmp_path, monkeypatch):
+    sink = app.MemorySink()
+    monkeypatch.setattr(app, "logger", app.EventLogger(sink, spool_dir=str(tmp_path / "spool")))
+    booking = app.booking_store.create({"phone": "9000000005", "city": "Delhi", "location": "Vasant Kunj",
+                                        "date": "04-01-2030", "time_slot": "Lunch (12:00 PM - 4:00 PM)", "guests": "2"})
+    app.slot_store.reserve("Vasant Kunj", "04-01-2030", "Lunch", 2)
+
+    # The phone number alone doesn't open the booking
+    context = {}
+    assert app.state_machine.step("verify_reference", "9000000005", context) == "verify_reference"
+    assert context == {"reference_error": "9000000005"}
+
+    context = {}
+    assert app.state_machine.step("verify_reference", booking["reference"].lower(), context) == "modification_options"
+    for state, message in [("modification_options", "3"), ("collect_guests", "3"), ("collect_phone", "9000000005"),
+                           ("booking_confirmation", "1"), ("booking_complete", "2")]:
+        state = app.state_machine.step(state, message, context)
+    assert state == "end"
+    assert context["reference"] == booking["reference"] and context["modified"] is True
+    assert app.booking_store.get(booking["reference"])["guests"] == "3"
+    assert app.slot_store.remaining("Vasant Kunj", "04-01-2030", "Lunch") == 77
+    app.logger.close()
+    assert [row[2] for row in sink.rows] == ["modification"]
+
+def test_sqlite_sink_reconnects_after_fork(app, tmp_path):
+    sink = app.SQLiteSink(str(tmp_path / "logs.db"))
+    sink.write_rows([["2030-01-01 12:00:00", "9000000001", "new_booking", "test"]])
+    inherited = sink._db()
+    pid = os.fork()
+    if pid == 0:
+        # The child must not write through the parent's connection
+        try:
+            sink.write_rows([["2030-01-01 12:00:01", "9000000002", "new_booking", "test"]])
+            os._exit(0 if sink._db() is not inherited else 1)
+        except BaseException:
+            os._exit(2)
+    assert os.waitpid(pid, 0)[1] == 0
+    phones = [row[0] for row in sink._db().execute("SELECT phone FROM logs ORDER BY timestamp")]
+    assert phones == ["9000000001", "9000000002"]
+
+def test_expired_session_restarts_without_reading_the_message(app, monkeypatch):
+    monkeypatch.setattr(app, "session_store", app.MemorySessionStore())
+    client = app.app.test_client()
+    first = client.post("/chat", json={"message": "1"}).get_json()
+    assert first["state"] == "collect_city"
+
+    # "1" answered a prompt of the lost session, not the main menu
+    reply = client.post("/chat", json={"message": "1", "session_id": "gone"}).get_json()
+    assert reply["session_expired"] is True
+    assert reply["state"] == "start"
+    assert reply["session_id"] not in ("gone", first["session_id"])
+    assert reply["response"].startswith("Sorry, your previous conversation has expired")
+
+    follow_up = client.post("/chat", json={"message": "1", "session_id": reply["session_id"]}).get_json()
+    assert "session_expired" not in follow_up
+    assert follow_up["state"] == "collect_city"
+
+# (state, input, context before, next state, context after)
+STEPS = [
+    ("start", "1", {}, "collect_city", {}),
+    ("start", "7", {}, "start", {}),
+    ("collect_city", "2", {}, "collect_location_delhi", {"city": "Delhi"}),
+    ("collect_city", "Mumbai", {}, "collect_city", {}),
+    ("collect_location_bangalore", "2", {"city": "Bangalore"}, "main_options", {"city": "Bangalore", "location": "JP Nagar"}),
+    ("collect_location_delhi", "back", {"city": "Delhi"}, "collect_city", {"city": "Delhi"}),
+    ("main_options", "3", {}, "knowledge_query", {}),
+    ("new_booking", "ok", {"reference": "K7Q2MX"}, "collect_date", {}),
+    ("collect_date", "01-01-2030", {"location": "Vasant Kunj"}, "collect_time",
+     {"location": "Vasant Kunj", "date": "01-01-2030", "seats": {"Lunch": 80, "Dinner": 80}}),
+    ("collect_time", "2", {}, "collect_guests", {"time_slot": "Dinner (6:30 PM - 11:00 PM)"}),
+    ("collect_guests", "21", {}, "collect_guests", {"guests": "21"}),
+    ("collect_guests", "4", {"location": "Vasant Kunj", "date": "01-01-2030", "time_slot": "Lunch (12:00 PM - 4:00 PM)"}, "collect_phone",
+     {"location": "Vasant Kunj", "date": "01-01-2030", "time_slot": "Lunch (12:00 PM - 4:00 PM)", "guests": "4"}),
+    ("collect_guests", "90", {"location": "Vasant Kunj", "date": "01-01-2030", "time_slot": "Lunch (12:00 PM - 4:00 PM)"}, "collect_guests",
+     {"location": "Vasant Kunj", "date": "01-01-2030", "time_slot": "Lunch (12:00 PM - 4:00 PM)", "guests": "90"}),
+    ("collect_phone", "12345", {}, "collect_phone", {"phone": "12345"}),
+    ("collect_phone", "9000000001", {}, "booking_confirmation", {"phone": "9000000001"}),
+    ("booking_confirmation", "2", {}, "new_booking", {}),
+    ("verify_reference", "ZZZZZZ", {}, "verify_reference", {"reference_error": "ZZZZZZ"}),
+    ("verify_reference", "back", {"reference_error": "ZZZZZZ"}, "modify_booking", {}),
+    ("collect_ratings", "6", {}, "collect_ratings", {"rating": "6"}),
+    ("collect_ratings", "5", {}, "collect_comments", {"rating": "5"}),
+    ("end", "1", {}, "end", {}),
+    ("no_such_state", "1", {}, "start", {}),
+]
+
+@pytest.mark.parametrize("state, user_input, before, expected_state, after", STEPS)
+def test_step(app, state, user_input, before, expected_state, after):
+    context = dict(before)
+    assert app.state_machine.step(state, user_input, context) == expected_state
+    assert context == after
+
+def test_step_logs_events_on_leaving_terminal_states(app, tmp_path, monkeypatch):
+    sink = app.MemorySink()
+    monkeypatch.setattr(app, "logger", app.EventLogger(sink, spool_dir=str(tmp_path / "spool")))
+    context = {"rating": "4", "phone": "9000000001"}
+    assert app.state_machine.step("feedback_complete", "2", context) == "end"
+    assert app.state_machine.step("end", "1", context) == "end"
+    app.logger.close()
+    assert [row[1:] for row in sink.rows] == [["9000000001", "feedback", "Rating: 4/5"]]
+
+def test_chat_end_to_end(app):
+    # Books a table, then asks a question, through /chat as Retell would
+    client = app.app.test_client()
+    state, context = "start", {}
+    def send(message):
+        nonlocal state, context
+        reply = client.post("/chat", json={"message": message, "state": state, "context": context}).get_json()
+        state, context = reply["state"], reply["context"]
+        return reply["response"]
+
+    for message in ["1", "1", "3", "1", "ok", "02-01-2030", "1", "2", "9000000002"]:
+        send(message)
+    assert state == "booking_confirmation"
+    response = send("1")
+    assert state == "booking_complete"
+    assert f"Reference number: {context['reference']}" in response
+    assert app.booking_store.get(context["reference"])["location"] == "Electronic City"
+    assert app.slot_store.remaining("Electronic City", "02-01-2030", "Lunch") == 78
+
+    for message in ["1", "1", "1", "3"]:
+        send(message)
+    assert state == "main_options"
+    send("3")
+    response = send("What parking facilities does the Electronic City outlet offer?")
+    assert state == "knowledge_response"
+    assert response.startswith("The Electronic City outlet offers self or chargeable parking.")
+
+PAIRS = [
+    {"query": "What time does the lunch buffet start?", "answer": "Lunch starts at noon."},
+    {"query": "Do you serve Jain food?", "answer": "Yes, on request."},
+    {"query": "Is there parking at the outlet?", "answer": "Valet parking.", "city": "Bangalore", "location": "JP Nagar"},
+    {"query": "Is there parking at the outlet?", "answer": "Street parking only.", "city": "Delhi", "location": "Janakpuri"},
+    {"query": "Can I bring a birthday cake?", "answer": "Yes, we also decorate the table.", "city": "Delhi"},
+]
+
+def make_kb(app, monkeypatch, **env):
+    from benchmark import HashingEncoder
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    kb = app.KnowledgeBase(model=HashingEncoder(), qa_pairs=PAIRS)
+    kb.load()
+    return kb
+
+@pytest.mark.parametrize("env", [
+    {},
+    {"KB_RETRIEVAL": "hybrid"},
+    {"KB_ANN": "ivf"},
+    {"KB_EMBEDDING_DTYPE": "int8"},
+    {"KB_EMBEDDING_DTYPE": "float16"},
+], ids=["dense", "hybrid", "ivf", "int8", "float16"])
+def test_query_modes_agree(app, monkeypatch, env):
+    kb = make_kb(app, monkeypatch, **env)
+    questions = ["What time does the lunch buffet start?", "do you serve JAIN food", "Can I bring a birthday cake?"]
+    answers = [kb.query(question)["answer"] for question in questions]
+    assert answers == ["Lunch starts at noon.", "Yes, on request.", "Yes, we also decorate the table."]
+    kb.answer_cache.clear()
+    assert [result["answer"] for result in kb.query_many(questions)] == answers
+
+@pytest.mark.parametrize("env", [{}, {"KB_RETRIEVAL": "hybrid"}], ids=["dense", "hybrid"])
+def test_query_is_scoped_to_the_callers_outlet(app, monkeypatch, env):
+    kb = make_kb(app, monkeypatch, **env)
+    question = "Is there parking at the outlet?"
+    assert kb.query(question, scope=("Bangalore", "JP Nagar"))["answer"] == "Valet parking."
+    assert kb.query(question, scope=("Delhi", "Janakpuri"))["answer"] == "Street parking only."
+    # The Delhi-wide pair isn't offered to Bangalore callers
+    assert kb.query("Can I bring a birthday cake?", scope=("Bangalore", ""))["answer"] != "Yes, we also decorate the table."
+    assert kb.query("Can I bring a birthday cake?", scope=("Delhi", "Janakpuri"))["answer"] == "Yes, we also decorate the table."
+
+def test_lexical_match_skips_out_of_scope_documents(app):
+    lexical = app.LexicalIndex(["Valet parking at JP Nagar?", "Is there parking?"], ["Yes.", "Street parking only."])
+    question = "Valet parking at JP Nagar?"
+    scores = lexical.scores(question)
+    assert lexical.best_match(question, scores) == (0, 1.0)
+    scores[0] = 0
+    assert lexical.best_match(question, scores)[0] == 1
+    assert lexical.best_match(question, np.zeros_like(scores)) == (None, 0.0)
+
+@pytest.mark.parametrize("env", [{}, {"KB_RETRIEVAL": "hybrid"}], ids=["dense", "hybrid"])
+def test_question_about_another_outlet_widens_the_scope(app, monkeypatch, env):
+    kb = make_kb(app, monkeypatch, **env)
+    assert kb.query("Is there parking at the JP Nagar outlet?", scope=("Delhi", "Janakpuri"))["answer"] == "Valet parking."
+    assert kb.query("Can I bring a birthday cake in Delhi?", scope=("Bangalore", "JP Nagar"))["answer"] == "Yes, we also decorate the table."
+    # Unknown places fall back to the whole city, or to everything
+    assert kb.query("Is there parking at the outlet?", scope=("Bangalore", "Nowhere"))["answer"] == "Valet parking."
+    assert kb.query("Can I bring a birthday cake?", scope=("Mumbai", ""))["answer"] == "Yes, we also decorate the table."
+    assert set(kb.index._routes) <= {("Bangalore", ""), ("Bangalore", "JP Nagar"), ("Delhi", ""), ("Delhi", "Janakpuri")}
+
+def test_scoped_caller_asking_about_another_outlet(app):
+    question = "What is the address of the JP Nagar outlet?"
+    answer = app.kb.query(question, scope=("Bangalore", "Indiranagar"))
+    assert answer == app.kb.query(question, scope=("Bangalore", "JP Nagar"))
+
+@pytest.mark.parametrize("dtype", ["float32", "int8", "float16"])
+def test_reload_encodes_only_changed_questions(app, tmp_path, monkeypatch, dtype):
+    from benchmark import HashingEncoder
+    monkeypatch.setenv("KB_EMBEDDING_DTYPE", dtype)
+    data = tmp_path / "knowledge"
+    data.mkdir()
+    path = data / "faq.jsonl"
+    path.write_text("".join(json.dumps(pair) + "\n" for pair in PAIRS[:2]))
+    kb = app.KnowledgeBase(model=HashingEncoder(), directory=str(data))
+    kb.load()
+    assert kb.query("Do you serve Jain food?")["answer"] == "Yes, on request."
+
+    path.write_text("".join(json.dumps(pair) + "\n" for pair in [PAIRS[0], dict(PAIRS[1], answer="Yes, every day.")]))
+    assert kb.reload()["encoded"] == 0  # Same questions, new answer
+    assert kb.query("Do you serve Jain food?")["answer"] == "Yes, every day."
+    with path.open("a") as f:
+        f.write(json.dumps(PAIRS[4]) + "\n")
+    assert kb.reload()["encoded"] == 1
+
+def test_metrics_endpoint(app):
+    client = app.app.test_client()
+    client.post("/chat", json={"message": "1", "state": "start", "context": {}})
+    body = client.get("/metrics").get_data(as_text=True)
+    assert 'stage="transition"' in body
+
+def test_render_cache_ignores_unrelated_context(app):
+    env = app.template_env
+    source = "{{ context.kb_response.answer }} {{ context.name }}"
+    paths = app.context_paths(env.parse(source))
+    assert paths == (("kb_response", "answer"), ("name",))
+
+    # Missing keys key on where the lookup stopped, not on what else is there
+    first = {"kb_response": {"answer": "Noon."}, "phone": "9000000001", "date": "01-01-2030"}
+    second = {"kb_response": {"answer": "Noon.", "source": "menu"}, "phone": "9000000002"}
+    assert [app.context_value(first, path) for path in paths] == [(2, "Noon."), (0, None)]
+    assert [app.context_value(first, path) for path in paths] == [app.context_value(second, path) for path in paths]
+    assert app.context_value({"kb_response": None}, ("kb_response", "answer")) == (1, None)
+
+    renderer = app.ResponseRenderer(env, ["knowledge_response.jinja"])
+    cache = renderer.caches["knowledge_response.jinja"]
+    context = {"kb_response": {"answer": "Noon.", "source": ""}, "city": "Delhi"}
+    for phone in ["9000000001", "9000000002", "9000000003"]:
+        response = renderer.render("knowledge_response.jinja", dict(context, phone=phone))
+    assert response.startswith("Noon.")
+    assert (cache.hits, cache.misses) == (2, 1)
+
+def test_chat_batch_replays_in_a_sandbox(app, monkeypatch):
+    client = app.app.test_client()
+    booking = {"state": "collect_phone", "messages": ["9000000003", "1"], "context": {
+        "city": "Delhi", "location": "Janakpuri", "date": "03-01-2030",
+        "time_slot": "Dinner (6:30 PM - 11:00 PM)", "guests": "5"}}
+    assert client.post("/chat/batch", json={"conversations": [booking]}).status_code == 403
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    assert client.post("/chat/batch", json={"conversations": [booking]}, headers={"Authorization": "Bearer wrong"}).status_code == 403
+
+    reply = client.post("/chat/batch", json={"conversations": [booking]}, headers={"Authorization": "Bearer secret"})
+    results = [json.loads(line) for line in reply.get_data(as_text=True).splitlines()]
+    assert [result["state"] for result in results] == ["booking_confirmation", "booking_complete"]
+    # Nothing reached the live stores
+    assert app.booking_store.get(results[-1]["context"]["reference"]) is None
+    assert app.booking_store.find_by_phone("9000000003") == []
+    assert app.slot_store.remaining("Janakpuri", "03-01-2030", "Dinner") == 80
+
+def test_replay_sandbox_keeps_logged_events(app):
+    sandbox = app.ReplaySandbox()
+    conversation = {"state": "collect_comments", "messages": ["Great food", "2"], "context": {"phone": "9000000004", "rating": "5"}}
+    assert [result["state"] for result in app.replay([conversation], sandbox)] == ["feedback_complete", "end"]
+    assert [row[1:] for row in sandbox.sink.rows] == [["9000000004", "feedback", "Rating: 5/5"]]
+    sandbox.close()
+
+def test_metrics_add_up_across_processes(app, tmp_path):
+    metrics = app.Metrics(directory=str(tmp_path), flush_interval=3600)
+    metrics.inc("turns", state="start")
+    metrics.observe("render", 0.002, "start")
+    metrics.collectors.append(lambda: [("cache_size", [("cache", "templates")], 5)])
+
+    def worker(turns, wait=None):
+        # Starts from zero and leaves a snapshot behind
+        pid = os.fork()
+        if pid == 0:
+            metrics.inc("turns", turns, state="start")
+            metrics.observe("render", 0.002, "start")
+            metrics.flush()
+            os.write(ready[1], b".")
+            if wait is not None:
+                os.read(wait, 1)
+            os._exit(0)
+        os.read(ready[0], 1)
+        return pid
+
+    ready, done = os.pipe(), os.pipe()
+    os.waitpid(worker(2), 0)
+    live = worker(4, wait=done[0])
+    try:
+        body = metrics.render()
+    finally:
+        os.write(done[1], b".")
+        os.waitpid(live, 0)
+    assert 'agentops_turns_total{state="start"} 7' in body
+    assert 'agentops_stage_seconds_count{stage="render",state="start"} 3' in body
+    # Gauges only from live processes: ours and the running worker's
+    assert 'agentops_cache_size{cache="templates"} 10' in body
+    assert "metrics-%d.json" % live in os.listdir(tmp_path)
+    assert "metrics-retired.json" in os.listdir(tmp_path)
+
+    # Once the second worker exits too its counts stay, its gauges don't
+    body = metrics.render()
+    assert 'agentops_turns_total{state="start"} 7' in body
+    assert 'agentops_cache_size{cache="templates"} 5' in body
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("metrics-") and name != "metrics-retired.json"]
+
+def test_workers_reloading_an_edit_encode_it_once(app, tmp_path, monkeypatch):
+    from benchmark import HashingEncoder
+    monkeypatch.setenv("KB_EMBEDDING_CACHE", str(tmp_path / "cache"))
+    data = tmp_path / "knowledge"
+    data.mkdir()
+    path = data / "faq.jsonl"
+    path.write_text("".join(json.dumps(pair) + "\n" for pair in PAIRS[:2]))
+    kb = app.KnowledgeBase(model=HashingEncoder(), directory=str(data))
+    kb.load()
+    with path.open("a") as f:
+        f.write(json.dumps(PAIRS[4]) + "\n")
+
+    pid = os.fork()
+    if pid == 0:
+        os._exit(kb.reload()["encoded"])
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 1
+    # The other worker maps what the first one saved instead of encoding
+    assert kb.reload()["encoded"] == 0
+    assert isinstance(kb.index.embeddings.base, np.memmap)
+    assert kb.query("Can I bring a birthday cake?")["answer"] == "Yes, we also decorate the table."
+
+def test_fork_during_a_load_does_not_deadlock_the_child(app):
+    import signal
+    with app.kb._load_lock:
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(10)
+            os._exit(0 if app.kb.reload() is not None else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+
+@pytest.mark.parametrize("env", [{}, {"KB_RETRIEVAL": "hybrid"}], ids=["dense", "hybrid"])
+def test_mixed_scopes_share_one_encode(app, monkeypatch, env):
+    kb = make_kb(app, monkeypatch, **env)
+    calls = []
+    encode = kb.model.encode
+    monkeypatch.setattr(kb.model, "encode", lambda texts, **kwargs: calls.append(list(texts)) or encode(texts, **kwargs))
+    question = "is there parking near the outlet"
+    requests = [(question, 0.3, ("Bangalore", "JP Nagar")), (question, 0.3, ("Delhi", "Janakpuri")),
+                ("lunch buffet time", 0.3, None), (question, 0.3, ("Bangalore", "JP Nagar"))]
+    batcher = app.QueryBatcher(kb, max_batch=len(requests), max_wait=5)
+    futures = [batcher.submit(*request) for request in requests]
+    answers = [future.result(timeout=10)["answer"] for future in futures]
+    assert answers == ["Valet parking.", "Street parking only.", "Lunch starts at noon.", "Valet parking."]
+    assert len(calls) == 1 and sorted(calls[0]) == ["is there parking near the outlet", "lunch buffet time"]
+
+    # Same answers one at a time
+    kb.answer_cache.clear()
+    assert [kb.query(*request)["answer"] for request in requests] == answers
+
+def test_templates_reload_in_development(app):
+    from jinja2 import DictLoader, Environment
+    templates = {"greeting.jinja": "Hello {{ context.name }}"}
+    env = Environment(loader=DictLoader(templates), auto_reload=False)
+    renderer = app.ResponseRenderer(env, ["greeting.jinja"])
+    templates["greeting.jinja"] = "Hi {{ context.name }}"
+    assert renderer.render("greeting.jinja", {"name": "Asha"}) == "Hello Asha"
+    env.auto_reload = True
+    assert renderer.render("greeting.jinja", {"name": "Asha"}) == "Hi Asha"
+
+def test_going_back_clears_the_reference_error(app):
+    client = app.app.test_client()
+    state, context = "verify_reference", {}
+    for message in ["ZZZZZZ", "back", "ok"]:
+        reply = client.post("/chat", json={"message": message, "state": state, "context": context}).get_json()
+        state, context = reply["state"], reply["context"]
+    assert state == "verify_reference"
+    assert "couldn't find" not in reply["response"]